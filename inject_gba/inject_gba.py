@@ -16,30 +16,36 @@ import	inject_gba.psb		as psb
 #	Read in a .psb.m file into our PSB object
 #	If there is a matching alldata.bin file, read that in too
 #
+#	If fileinfo_only is set, only the names and file_info are read.
+#	This is enough to extract the rom, but not to write a new psb.
+#
 
-def	load_from_psb(psb_filename):
+def	load_from_psb(psb_filename, fileinfo_only = False):
 	if not psb_filename:
 		return None
 
 	if global_vars.verbose:
 		print("Reading '%s'" % psb_filename)
 
-	# Read in the encrypted/compressed psb data
-	psb_data2 = bytearray(open(psb_filename, 'rb').read())
+	with open(psb_filename, 'rb') as f:
+		if psb_filename.endswith('.psb'):
+			# ".psb" files are not compressed, use the data as-is
+			psb_data0 = bytearray(f.read())
+		else:
+			# Stream the encrypted/compressed psb data through the decrypter and decompressor.
+			# The filename is the decryption key.
+			debug_fd = None
+			if global_vars.verbose > global_vars.debug_level:
+				debug_fd = open(psb_filename + '.1', 'wb')	# compressed
 
-	# Decrypt the psb data using the filename as the key
-	psb_data1 = psb.unobfuscate_data(psb_data2, psb_filename)
-	if global_vars.verbose > global_vars.debug_level:
-		open(psb_filename + '.1', 'wb').write(psb_data1)	# compressed
+			psb_data0 = bytearray()
+			for data in psb.uncompress_stream(f, psb_filename, debug_fd = debug_fd):
+				psb_data0 += data
 
-	if psb_filename.endswith('.psb'):
-		# ".psb" files are not compressed, use the decrypted data
-		psb_data0 = psb_data2
-	else:
-		# Uncompress the psb data
-		psb_data0 = psb.uncompress_data(psb_data1)
-		if global_vars.verbose > global_vars.debug_level:
-			open(psb_filename + '.0', 'wb').write(psb_data0)	# raw
+			if debug_fd:
+				debug_fd.close()
+			if global_vars.verbose > global_vars.debug_level:
+				open(psb_filename + '.0', 'wb').write(psb_data0)	# raw
 
 	# Check we have a PSB header
 	header = psb.HDRLEN()
@@ -49,8 +55,12 @@ def	load_from_psb(psb_filename):
 		return
 
 	# Unpack the PSB structure
+	# We only need the file_info from the entries tree, so decode the rest on demand
 	mypsb = psb.PSB()
-	mypsb.unpack(psb_data0)
+	if fileinfo_only:
+		mypsb.unpack_fileinfo(psb_data0)
+	else:
+		mypsb.unpack(psb_data0, lazy = True)
 
 	# Get the base filename without any .psb.m
 	# '.psb.m' isn't a single extension :(
@@ -66,11 +76,11 @@ def	load_from_psb(psb_filename):
 	if os.path.isfile(bin_filename):
 		if global_vars.verbose:
 			print("Reading file %s" % bin_filename)
-		bin_data = bytearray(open(bin_filename, 'rb').read())
 
 		# Split the ADB data into each subfile.
-		# The data is in compressed/encrypted form
-		mypsb.split_subfiles(bin_data)
+		# The data is in compressed/encrypted form.
+		# The file is mapped, so we only read the subfiles we use.
+		mypsb.map_subfiles(bin_filename)
 
 	return mypsb
 
@@ -113,13 +123,14 @@ def	read_rom(mypsb, filename):
 #	This is the main read/write logic
 #
 
-def	release_the_kraken(inpsb, outrom, inrom, outpsb):
+def	release_the_kraken(inpsb, outrom, inrom, outpsb, in_place = False):
 	# We must have an inpsb (this should be enforced by the parser)
 	if not inpsb:
 		parser.print_help()
 		exit(1)
 
-	mypsb = load_from_psb(inpsb)
+	# If we are not writing a new psb, we only need the file_info
+	mypsb = load_from_psb(inpsb, fileinfo_only = not outpsb)
 
 	# If we have outrom, write it out
 	if outrom:
@@ -131,9 +142,63 @@ def	release_the_kraken(inpsb, outrom, inrom, outpsb):
 
 	# If we have outpsb, write it out
 	if outpsb:
+		# If the rom fits in its old slot, only patch the files
+		if in_place and patch_in_place(mypsb, outpsb):
+			return
 		write_psb(mypsb, outpsb)
 		write_bin(mypsb, outpsb)
 
+##################################################
+#
+#	patch_in_place
+#
+#	Write the new rom over the old rom in the existing alldata.bin, if it fits in the old rom's slot.
+#	The offsets of the other subfiles stay the same, so only the rom's slot is written.
+#	The psb is only re-written if the rom's length has changed.
+#
+#	With --create-backup, both files are backed up before either is changed.
+#	The psb is written before the alldata.bin is patched.
+#	If we are interrupted, restore the .bak files together.
+#
+#	Returns False if the layout has changed, and the files need a full re-write.
+#
+
+def	patch_in_place(mypsb, psb_filename):
+	if not mypsb or not mypsb.bin_filename:
+		return False
+
+	i = mypsb.get_rom_index()
+	if i is None or not mypsb.subfile_fits(i):
+		if global_vars.verbose:
+			print("Rom does not fit in its old slot, re-writing all files")
+		return False
+
+	# The alldata.bin is changed in place, so it can't be renamed to the backup like the psb
+	copy_backup(mypsb.bin_filename)
+
+	# Patch the new length into the psb
+	mypsb.keep_subfile_slot(i)
+	if mypsb.fileinfo_changed:
+		write_psb(mypsb, psb_filename)
+
+	if global_vars.verbose:
+		print("Patching '%s'" % mypsb.bin_filename)
+
+	with open(mypsb.bin_filename, 'r+b') as f:
+		mypsb.patch_subfile(f, i)
+
+	return True
+
+##################################################
+#
+#	want_backup
+#
+#	Check if we should create a .bak for a file: backups are enabled, the file exists, and no .bak exists
+#
+
+def	want_backup(filename):
+	return global_vars.options.create_backup and os.path.isfile(filename) and not os.path.isfile(filename + '.bak') and not os.path.isdir(filename + '.bak') and not os.path.ismount(filename + '.bak')
+
 ##################################################
 #
 #	rename_backup
@@ -146,7 +211,7 @@ def	release_the_kraken(inpsb, outrom, inrom, outpsb):
 def	rename_backup(filename):
 
 	# Optionally create a .bak if none exist
-	if global_vars.options.create_backup and os.path.isfile(filename) and not os.path.isfile(filename + '.bak') and not os.path.isdir(filename + '.bak') and not os.path.ismount(filename + '.bak'):
+	if want_backup(filename):
 		os.rename(filename, filename + '.bak')
 
 	# Optionally refuse to overwrite the existing file
@@ -156,6 +221,21 @@ def	rename_backup(filename):
 
 	return True
 
+##################################################
+#
+#	copy_backup
+#
+#	Optionally create a backup copy of a file we are about to modify in place
+#
+
+def	copy_backup(filename):
+
+	# Optionally create a .bak if none exist
+	if want_backup(filename):
+		if global_vars.verbose:
+			print("Copying '%s' to '%s'" % (filename, filename + '.bak'))
+		shutil.copyfile(filename, filename + '.bak')
+
 ##################################################
 #
 #	write_bin
@@ -167,9 +247,7 @@ def	write_bin(mypsb, psb_filename):
 	if not mypsb or not psb_filename:
 		return
 
-	# Join the subfiles back into a single ADB
-	bin_data = mypsb.join_subfiles()
-	if bin_data is None:
+	if not mypsb.fileinfo:
 		return
 
 	if psb_filename.endswith('.psb'):
@@ -181,13 +259,19 @@ def	write_bin(mypsb, psb_filename):
 
 	filename = basename + '.bin'
 
+	# Make sure we are not still reading subfiles from the file we are replacing
+	if mypsb.bin_filename and os.path.isfile(filename) and os.path.samefile(filename, mypsb.bin_filename):
+		mypsb.unmap_subfiles()
+
 	if not rename_backup(filename):
 		return
 
 	if global_vars.verbose:
 		print("Writing '%s'" % filename)
 
-	open(filename, 'wb').write(bytes(bin_data))
+	# Write the subfiles straight into the ADB
+	with open(filename, 'wb') as f:
+		mypsb.write_subfiles(f)
 
 ##################################################
 #
@@ -218,18 +302,23 @@ def	write_psb(mypsb, filename):
 		open(filename, 'wb').write(psb_data0)
 
 	elif filename.endswith('.psb.m'):
-		# Compress the PSB data
-		psb_data1 = psb.compress_data(psb_data0)
+		# Compress the PSB data, and encrypt it using the filename as the key
+		debug_fd1 = None
+		debug_fd2 = None
 		if global_vars.verbose > global_vars.debug_level:
-			open(filename + '.1', 'wb').write(psb_data1)	# compressed
-
-		# Encrypt the PSB data using the filename as the key
-		psb_data2 = psb.unobfuscate_data(psb_data1, filename)
-		if global_vars.verbose > global_vars.debug_level:
-			open(filename + '.2', 'wb').write(psb_data2)	# compressed/encrypted
+			debug_fd1 = open(filename + '.1', 'wb')	# compressed
+			debug_fd2 = open(filename + '.2', 'wb')	# compressed/encrypted
 
 		# Write out the compressed/encrypted PSB data
-		open(filename, 'wb').write(psb_data2)
+		with open(filename, 'wb') as f:
+			for data in psb.compress_stream(psb_data0, filename, debug_fd = debug_fd1):
+				f.write(data)
+				if debug_fd2:
+					debug_fd2.write(data)
+
+		if debug_fd1:
+			debug_fd1.close()
+			debug_fd2.close()
 
 ##################################################
 #
@@ -284,6 +373,18 @@ This will:
 
 * Create /path/to/new/alldata{.psb.m, .bin}
 
+-----
+
+To inject a rom in place:
+
+%(prog)s --inpsb /path/to/alldata.psb.m --inrom /path/to/new.rom --in-place
+
+This will:
+* Read in /path/to/alldata{.psb.m, .bin}
+
+* If the new rom fits in the space of the original rom, over-write just that part of /path/to/alldata.bin
+  Otherwise, re-write /path/to/alldata{.psb.m, .bin}
+
 -----
 """
 	parser = argparse.ArgumentParser(
@@ -301,10 +402,13 @@ This will:
 	group_pad.add_argument(		'--pad00',	dest='pad00',		help='Pad new rom with 00',			action='store_true',	default=False)
 	group_pad.add_argument(		'--padFF',	dest='padFF',		help='Pad new rom with FF',			action='store_true',	default=False)
 
+	parser.add_argument(		'--key-store',		dest='key_store',		help='Cache derived XOR keys in KEYSTORE',		metavar='KEYSTORE')
+
 	parser.add_argument(		'--inpsb',	dest='inpsb',		help='Read INPSB',				metavar='INPSB',	required=True)
 	parser.add_argument(		'--outrom',	dest='outrom',		help='Write the rom file to OUTROM',		metavar='OUTROM')
 	parser.add_argument(		'--inrom',	dest='inrom',		help='Replace the rom file with INROM',		metavar='INROM')
 	parser.add_argument(		'--outpsb',	dest='outpsb',		help='Write new psb to OUTPSB',			metavar='OUTPSB')
+	parser.add_argument(		'--in-place',	dest='in_place',	help='Inject INROM into INPSB in place (implies --allow-overwrite)',	action='store_true',	default=False)
 
 	if len(sys.argv) <= 1:
 		parser.print_help()
@@ -313,7 +417,19 @@ This will:
 	global_vars.options = parser.parse_args()
 	global_vars.verbose = global_vars.options.verbose
 
-	release_the_kraken(global_vars.options.inpsb, global_vars.options.outrom, global_vars.options.inrom, global_vars.options.outpsb)
+	if global_vars.options.in_place:
+		if not global_vars.options.inrom:
+			parser.error("--in-place requires --inrom")
+		if global_vars.options.outpsb:
+			parser.error("--in-place can not be used with --outpsb")
+		# We write back to INPSB
+		global_vars.options.outpsb		= global_vars.options.inpsb
+		global_vars.options.allow_overwrite	= True
+
+	if global_vars.options.key_store:
+		psb.xor_key_cache.open_store(global_vars.options.key_store)
+
+	release_the_kraken(global_vars.options.inpsb, global_vars.options.outrom, global_vars.options.inrom, global_vars.options.outpsb, global_vars.options.in_place)
 
 ##################################################
 #
@@ -329,6 +445,7 @@ def	main_batch():
 	parser.add_argument('-v',	'--verbose',	dest='verbose',		help='verbose output',				action='count',		default=0)
 
 	parser.add_argument(		'--base',		dest='base',			help='Copy base game directory from BASE',	metavar='BASE',		default='base')
+	parser.add_argument(		'--key-store',		dest='key_store',		help='Cache derived XOR keys in KEYSTORE',		metavar='KEYSTORE')
 
 	parser.add_argument(		'--prefix',		dest='prefix',			help='Prefix new rom with PREFIX',		metavar='PREFIX')
 	group_pad = parser.add_mutually_exclusive_group()
@@ -352,6 +469,15 @@ def	main_batch():
 		print("Base '%s' not found" % global_vars.options.base)
 		return
 
+	if global_vars.options.key_store:
+		psb.xor_key_cache.open_store(global_vars.options.key_store)
+
+	# Read the base game once, and inject each rom into a copy of it.
+	# The base alldata.bin stays mapped, so the subfiles we don't replace are copied straight from it.
+	template = load_from_psb(os.path.join(global_vars.options.base, 'content', 'alldata.psb.m'))
+	if not template:
+		return
+
 	for file in global_vars.options.files:
 
 		if global_vars.verbose >= global_vars.info_level:
@@ -375,9 +501,19 @@ def	main_batch():
 		# Copy our base game into the rom directory
 		shutil.copytree(global_vars.options.base, file_base)
 
-		psb = os.path.join(file_base, 'content', 'alldata.psb.m')
+		psb_filename = os.path.join(file_base, 'content', 'alldata.psb.m')
+
+		mypsb = template.clone()
+		read_rom(mypsb, file)
+		write_psb(mypsb, psb_filename)
+		write_bin(mypsb, psb_filename)
+
+	# Release the base, without reading in its subfiles
+	template.subfile_data = None
+	template.unmap_subfiles()
 
-		release_the_kraken(psb, None, file, psb)
+	if global_vars.verbose >= global_vars.trace_level:
+		print(psb.xor_key_cache)
 
 ##################################################
 #
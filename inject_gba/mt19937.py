@@ -32,8 +32,8 @@
 ##  matumoto@math.keio.ac.jp
 
 
+import	array
 import sys
-import	ctypes
 # for debugging
 import	binascii
 
@@ -60,195 +60,230 @@ def TEMPERING_SHIFT_T(y):
 def TEMPERING_SHIFT_L(y):
     return (y >> 18)
 
-mt = []   # the array for the state vector
-mti = N+1 # mti==N+1 means mt[N] is not initialized
-
-# initializing the array with a NONZERO seed
-"""
-/* initializes mt[N] with a seed */
-void init_genrand(unsigned long s)
-{
-    mt[0]= s & 0xffffffffUL;
-    for (mti=1; mti<N; mti++) {
-        mt[mti] = 
-	    (1812433253UL * (mt[mti-1] ^ (mt[mti-1] >> 30)) + mti); 
-        /* See Knuth TAOCP Vol2. 3rd Ed. P.106 for multiplier. */
-        /* In the previous versions, MSBs of the seed affect   */
-        /* only MSBs of the array mt[].                        */
-        /* 2002/01/09 modified by Makoto Matsumoto             */
-        mt[mti] &= 0xffffffffUL;
-        /* for >32 bit machines */
-    }
-}
-"""
-def init_genrand(seed):
-  # setting initial seeds to mt[N] using
-  # the generator Line 25 of Table 1 in
-  # [KNUTH 1981, The Art of Computer Programming
-  #    Vol. 2 (2nd Ed.), pp102]
-
-	#print("init_genrand", seed)
-	global mt, mti
-
-	mt = [None] * N
-	mt[0] = ctypes.c_uint32(seed).value
-
-	mti = 1
-	while (mti < N):
-		mt[mti] = ctypes.c_uint32(1812433253 * (mt[mti - 1] ^ (mt[mti - 1] >> 30)) + mti).value
-		mti += 1
-	return
-	print("mti %d" % mti)
-	for i in range(0, N):
-		print("%X" % mt[i])
-# end init_genrand
-
-"""
-/* initialize by an array with array-length */
-/* init_key is the array for initializing keys */
-/* key_length is its length */
-/* slight change for C++, 2004/2/26 */
-void init_by_array(unsigned long init_key[], int key_length)
-{
-    int i, j, k;
-    init_genrand(19650218UL);
-    i=1; j=0;
-    k = (N>key_length ? N : key_length);
-    for (; k; k--) {
-        mt[i] = (mt[i] ^ ((mt[i-1] ^ (mt[i-1] >> 30)) * 1664525UL))
-          + init_key[j] + j; /* non linear */
-        mt[i] &= 0xffffffffUL; /* for WORDSIZE > 32 machines */
-        i++; j++;
-        if (i>=N) { mt[0] = mt[N-1]; i=1; }
-        if (j>=key_length) j=0;
-    }
-    for (k=N-1; k; k--) {
-        mt[i] = (mt[i] ^ ((mt[i-1] ^ (mt[i-1] >> 30)) * 1566083941UL))
-          - i; /* non linear */
-        mt[i] &= 0xffffffffUL; /* for WORDSIZE > 32 machines */
-        i++;
-        if (i>=N) { mt[0] = mt[N-1]; i=1; }
-    }
-
-    mt[0] = 0x80000000UL; /* MSB is 1; assuring non-zero initial array */ 
-}
-"""
-def	init_by_array(init_key):
-	key_length = len(init_key)
-
-	#print("init_by_array len", key_length)
-
-	init_genrand(19650218)
-	i = 1
-	j = 0
-	k = N if N > key_length else key_length
-	while (k > 0):
-		mt[i] = ctypes.c_uint32((mt[i] ^ ((mt[i-1] ^ (mt[i-1] >> 30)) * 1664525)) + init_key[j] + j).value
-		i += 1
-		j += 1
-		if (i >= N):
-			mt[0] = mt[N - 1]
-			i = 1
-		if (j >= key_length):
-			j = 0
-		k -= 1
-
-	k = N - 1
-	while (k > 0):
-		mt[i] = ctypes.c_uint32((mt[i] ^ ((mt[i-1] ^ (mt[i-1] >> 30)) * 1566083941)) - i).value
-		i += 1
-		if (i >= N):
-			mt[0] = mt[N - 1]
-			i = 1
-		k -= 1
-	mt[0] = 0x80000000	# MSB is 1; assuring non-zero initial array
-
-"""
-/* generates a random number on [0,0xffffffff]-interval */
-unsigned long genrand_int32(void)
-{
-    unsigned long y;
-    static unsigned long mag01[2]={0x0UL, MATRIX_A};
-    /* mag01[x] = x * MATRIX_A  for x=0,1 */
-
-    if (mti >= N) { /* generate N words at one time */
-        int kk;
-
-        if (mti == N+1)   /* if init_genrand() has not been called, */
-            init_genrand(5489UL); /* a default initial seed is used */
-
-        for (kk=0;kk<N-M;kk++) {
-            y = (mt[kk]&UPPER_MASK)|(mt[kk+1]&LOWER_MASK);
-            mt[kk] = mt[kk+M] ^ (y >> 1) ^ mag01[y & 0x1UL];
-        }
-        for (;kk<N-1;kk++) {
-            y = (mt[kk]&UPPER_MASK)|(mt[kk+1]&LOWER_MASK);
-            mt[kk] = mt[kk+(M-N)] ^ (y >> 1) ^ mag01[y & 0x1UL];
-        }
-        y = (mt[N-1]&UPPER_MASK)|(mt[0]&LOWER_MASK);
-        mt[N-1] = mt[M-1] ^ (y >> 1) ^ mag01[y & 0x1UL];
-
-        mti = 0;
-    }
-  
-    y = mt[mti++];
-
-    /* Tempering */
-    y ^= (y >> 11);
-    y ^= (y << 7) & 0x9d2c5680UL;
-    y ^= (y << 15) & 0xefc60000UL;
-    y ^= (y >> 18);
-
-    return y;
-}
-"""
-
-def genrand_int32():
-	global mt, mti
-
-	mag01 = [0x0, MATRIX_A]
-	# mag01[x] = x * MATRIX_A  for x=0,1
-	y = 0
-
-	if mti >= N: # generate N words at one time
-		if mti == N+1:   # if init_genrand() has not been called,
-			init_genrand(5489) # a default initial seed is used
-
-		kk = 0
-		while (kk < N-M):
+# mask to keep values to 32 bits (replaces the C "unsigned long" wrap-around)
+MASK_32 = 0xffffffff
+
+class	MT19937:
+	def	__init__(self, seed=None):
+		self.mt = [0] * N	# the array for the state vector
+		self.mti = N+1		# mti==N+1 means mt[N] is not initialized
+		if seed is not None:
+			self.init_genrand(seed)
+
+	# initializing the array with a NONZERO seed
+	"""
+	/* initializes mt[N] with a seed */
+	void init_genrand(unsigned long s)
+	{
+	    mt[0]= s & 0xffffffffUL;
+	    for (mti=1; mti<N; mti++) {
+	        mt[mti] = 
+		    (1812433253UL * (mt[mti-1] ^ (mt[mti-1] >> 30)) + mti); 
+	        /* See Knuth TAOCP Vol2. 3rd Ed. P.106 for multiplier. */
+	        /* In the previous versions, MSBs of the seed affect   */
+	        /* only MSBs of the array mt[].                        */
+	        /* 2002/01/09 modified by Makoto Matsumoto             */
+	        mt[mti] &= 0xffffffffUL;
+	        /* for >32 bit machines */
+	    }
+	}
+	"""
+	def	init_genrand(self, seed):
+	  # setting initial seeds to mt[N] using
+	  # the generator Line 25 of Table 1 in
+	  # [KNUTH 1981, The Art of Computer Programming
+	  #    Vol. 2 (2nd Ed.), pp102]
+
+		mt = [0] * N
+		mt[0] = prev = seed & MASK_32
+		for i in range(1, N):
+			prev = (1812433253 * (prev ^ (prev >> 30)) + i) & MASK_32
+			mt[i] = prev
+		self.mt = mt
+		self.mti = N
+	# end init_genrand
+
+	"""
+	/* initialize by an array with array-length */
+	/* init_key is the array for initializing keys */
+	/* key_length is its length */
+	/* slight change for C++, 2004/2/26 */
+	void init_by_array(unsigned long init_key[], int key_length)
+	{
+	    int i, j, k;
+	    init_genrand(19650218UL);
+	    i=1; j=0;
+	    k = (N>key_length ? N : key_length);
+	    for (; k; k--) {
+	        mt[i] = (mt[i] ^ ((mt[i-1] ^ (mt[i-1] >> 30)) * 1664525UL))
+	          + init_key[j] + j; /* non linear */
+	        mt[i] &= 0xffffffffUL; /* for WORDSIZE > 32 machines */
+	        i++; j++;
+	        if (i>=N) { mt[0] = mt[N-1]; i=1; }
+	        if (j>=key_length) j=0;
+	    }
+	    for (k=N-1; k; k--) {
+	        mt[i] = (mt[i] ^ ((mt[i-1] ^ (mt[i-1] >> 30)) * 1566083941UL))
+	          - i; /* non linear */
+	        mt[i] &= 0xffffffffUL; /* for WORDSIZE > 32 machines */
+	        i++;
+	        if (i>=N) { mt[0] = mt[N-1]; i=1; }
+	    }
+
+	    mt[0] = 0x80000000UL; /* MSB is 1; assuring non-zero initial array */ 
+	}
+	"""
+	def	init_by_array(self, init_key):
+		key_length = len(init_key)
+
+		self.init_genrand(19650218)
+		mt = self.mt
+		i = 1
+		j = 0
+		k = N if N > key_length else key_length
+		while (k > 0):
+			mt[i] = ((mt[i] ^ ((mt[i-1] ^ (mt[i-1] >> 30)) * 1664525)) + init_key[j] + j) & MASK_32
+			i += 1
+			j += 1
+			if (i >= N):
+				mt[0] = mt[N - 1]
+				i = 1
+			if (j >= key_length):
+				j = 0
+			k -= 1
+
+		k = N - 1
+		while (k > 0):
+			mt[i] = ((mt[i] ^ ((mt[i-1] ^ (mt[i-1] >> 30)) * 1566083941)) - i) & MASK_32
+			i += 1
+			if (i >= N):
+				mt[0] = mt[N - 1]
+				i = 1
+			k -= 1
+		mt[0] = 0x80000000	# MSB is 1; assuring non-zero initial array
+
+	# generate N words at one time
+	def	twist(self):
+		if self.mti == N+1:	# if init_genrand() has not been called,
+			self.init_genrand(5489)	# a default initial seed is used
+
+		mt = self.mt
+		mag01 = (0x0, MATRIX_A)
+		# mag01[x] = x * MATRIX_A  for x=0,1
+		for kk in range(N-M):
 			y = (mt[kk]&UPPER_MASK)|(mt[kk+1]&LOWER_MASK)
 			mt[kk] = mt[kk+M] ^ (y >> 1) ^ mag01[y & 0x1]
-			kk += 1
-
-		while (kk < N-1):
+		for kk in range(N-M, N-1):
 			y = (mt[kk]&UPPER_MASK)|(mt[kk+1]&LOWER_MASK)
 			mt[kk] = mt[kk+(M-N)] ^ (y >> 1) ^ mag01[y & 0x1]
-			kk += 1
-
 		y = (mt[N-1]&UPPER_MASK)|(mt[0]&LOWER_MASK)
 		mt[N-1] = mt[M-1] ^ (y >> 1) ^ mag01[y & 0x1]
 
-		mti = 0
+		self.mti = 0
+
+	"""
+	/* generates a random number on [0,0xffffffff]-interval */
+	unsigned long genrand_int32(void)
+	{
+	    unsigned long y;
+	    static unsigned long mag01[2]={0x0UL, MATRIX_A};
+	    /* mag01[x] = x * MATRIX_A  for x=0,1 */
+
+	    if (mti >= N) { /* generate N words at one time */
+	        int kk;
+
+	        if (mti == N+1)   /* if init_genrand() has not been called, */
+	            init_genrand(5489UL); /* a default initial seed is used */
+
+	        for (kk=0;kk<N-M;kk++) {
+	            y = (mt[kk]&UPPER_MASK)|(mt[kk+1]&LOWER_MASK);
+	            mt[kk] = mt[kk+M] ^ (y >> 1) ^ mag01[y & 0x1UL];
+	        }
+	        for (;kk<N-1;kk++) {
+	            y = (mt[kk]&UPPER_MASK)|(mt[kk+1]&LOWER_MASK);
+	            mt[kk] = mt[kk+(M-N)] ^ (y >> 1) ^ mag01[y & 0x1UL];
+	        }
+	        y = (mt[N-1]&UPPER_MASK)|(mt[0]&LOWER_MASK);
+	        mt[N-1] = mt[M-1] ^ (y >> 1) ^ mag01[y & 0x1UL];
+
+	        mti = 0;
+	    }
+	  
+	    y = mt[mti++];
+
+	    /* Tempering */
+	    y ^= (y >> 11);
+	    y ^= (y << 7) & 0x9d2c5680UL;
+	    y ^= (y << 15) & 0xefc60000UL;
+	    y ^= (y >> 18);
+
+	    return y;
+	}
+	"""
+	def	genrand_int32(self):
+		if self.mti >= N:
+			self.twist()
+
+		y = self.mt[self.mti]
+		self.mti += 1
+		y ^= TEMPERING_SHIFT_U(y)
+		y ^= TEMPERING_SHIFT_S(y) & TEMPERING_MASK_B
+		y ^= TEMPERING_SHIFT_T(y) & TEMPERING_MASK_C
+		y ^= TEMPERING_SHIFT_L(y)
+
+		return y
+
+	# Generate the next n words in one call.
+	# Returns an array('I') of the words, or the words as little-endian bytes if as_bytes is set.
+	def	genrand_block(self, n, as_bytes=False):
+		out = array.array('I')
+		while len(out) < n:
+			if self.mti >= N:
+				self.twist()
+
+			# Temper as many words as we need from the current state
+			end = min(N, self.mti + n - len(out))
+			for y in self.mt[self.mti : end]:
+				y ^= (y >> 11)
+				y ^= (y << 7) & TEMPERING_MASK_B
+				y ^= (y << 15) & TEMPERING_MASK_C
+				y ^= (y >> 18)
+				out.append(y)
+			self.mti = end
+
+		if as_bytes:
+			if sys.byteorder != 'little':
+				out.byteswap()
+			return out.tobytes()
+		return out
+
+	"""
+	double genrand_real2(void)
+	{
+	    return genrand_int32()*(1.0/4294967296.0); 
+	    /* divided by 2^32 */
+	}
+	"""
+	def	genrand_real2(self):
+		return self.genrand_int32()*(1.0/4294967296.0)
+
+#
+# Module-level generator for the original function API.
+# This is shared state, create a MT19937 per thread instead.
+#
+_default = MT19937()
+
+def	init_genrand(seed):
+	_default.init_genrand(seed)
 
-	y = mt[mti]
-	mti += 1
-	y ^= TEMPERING_SHIFT_U(y)
-	y ^= TEMPERING_SHIFT_S(y) & TEMPERING_MASK_B
-	y ^= TEMPERING_SHIFT_T(y) & TEMPERING_MASK_C
-	y ^= TEMPERING_SHIFT_L(y)
-
-	return y;
+def	init_by_array(init_key):
+	_default.init_by_array(init_key)
 
-"""
-double genrand_real2(void)
-{
-    return genrand_int32()*(1.0/4294967296.0); 
-    /* divided by 2^32 */
-}
-"""
+def	genrand_int32():
+	return _default.genrand_int32()
 
-def genrand_real2():
-	return genrand_int32()*(1.0/4294967296.0)
+def	genrand_real2():
+	return _default.genrand_real2()
 
 
 def main():
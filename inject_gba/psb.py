@@ -1,52 +1,62 @@
 
 import	binascii
+import	bisect
 import	collections
+import	copy
 import	ctypes
+import	fnmatch
 import	hashlib
 import	html
+import	mmap
 import	optparse
 import	os
 import	struct
 import	sys
+import	threading
 import	yaml
 import	zlib
 
 import	inject_gba.global_vars	as global_vars
 import	inject_gba.mt19937	as mt19937
 
+# numpy is optional, it speeds up the XOR of large buffers
+try:
+	import	numpy
+except ImportError:
+	numpy = None
+
 #
 # Define our object classes
 #
-# Note: we can't use __slots__ to save memory because that breaks __dict__ which we need for serialization
+# These use __slots__ to keep the decoded tree small.
+# They are serialized to/from YAML by PSB_YAMLDumper and PSB_YAMLLoader below.
 #
-class	TypeValue(yaml.YAMLObject):
-	yaml_tag = u'!TV'
+class	TypeValue():
+	__slots__ = ('t', 'v')
 	def	__init__(self, t, v):
 		self.t = t
 		self.v = v
 	def	__repr__(self):
 		return "%s(t=%r, v=%r)" % (self.__class__.__name__, self.t, self.v)
 
-class	NameObject(yaml.YAMLObject):
-	yaml_tag = u'!NO'
-	def	__init__(self, ni, o, ns=None):
+class	NameObject():
+	__slots__ = ('ni', 'o')
+	def	__init__(self, ni, o):
 		self.ni = ni	# index into names[]
 		self.o  = o	# object
-		self.ns = ns	# For debugging, the name string from names[]
 	def	__repr__(self):
-		return "%s(ni=%r, o=%r, ns=%r)" % (self.__class__.__name__, self.ni, self.o, self.ns)
+		return "%s(ni=%r, o=%r)" % (self.__class__.__name__, self.ni, self.o)
 
-class	String(yaml.YAMLObject):
-	yaml_tag = u'!STR'
-	def	__init__(self, t, v, s=None):
+class	String():
+	__slots__ = ('t', 'v')
+	def	__init__(self, t, v):
 		self.t = t
 		self.v = v	# index into strings[]
-		self.s = s	# For debugging, the string
 	def	__repr__(self):
-		return "%s(t=%r, v=%r, s=%r)" % (self.__class__.__name__, self.t, self.v, self.s)
+		return "%s(t=%r, v=%r)" % (self.__class__.__name__, self.t, self.v)
 
-class	FileInfo(yaml.YAMLObject):
-	yaml_tag = u'!FI'
+class	FileInfo():
+	__slots__ = ('ni', 'l', 'o')
 	def	__init__(self, ni, l, o,):
 		self.ni	= ni	# index into names[]
 		self.l	= l	# original length
@@ -54,6 +64,155 @@ class	FileInfo(yaml.YAMLObject):
 	def	__repr__(self):
 		return "%s(ni=%r, l=%r, o=%r)" % (self.__class__.__name__, self.ni, self.l, self.o)
 
+#
+# YAML serialization of our object classes.
+#
+# For readability, the NameObject name (ns) and String value (s) are written out too.
+# The dumper gets these from its psb, and the loader ignores them.
+#
+class	PSB_YAMLDumper(yaml.SafeDumper):
+	psb = None
+
+	def	represent_TypeValue(self, obj):
+		return self.represent_mapping(u'!TV', {'t': obj.t, 'v': obj.v})
+
+	def	represent_NameObject(self, obj):
+		return self.represent_mapping(u'!NO', {'ni': obj.ni, 'ns': self.psb.names[obj.ni], 'o': obj.o})
+
+	def	represent_String(self, obj):
+		return self.represent_mapping(u'!STR', {'t': obj.t, 'v': obj.v, 's': self.psb.strings[obj.v]})
+
+	def	represent_FileInfo(self, obj):
+		return self.represent_mapping(u'!FI', {'ni': obj.ni, 'l': obj.l, 'o': obj.o})
+
+PSB_YAMLDumper.add_multi_representer(TypeValue,	PSB_YAMLDumper.represent_TypeValue)
+PSB_YAMLDumper.add_representer(NameObject,	PSB_YAMLDumper.represent_NameObject)
+PSB_YAMLDumper.add_representer(String,		PSB_YAMLDumper.represent_String)
+PSB_YAMLDumper.add_representer(FileInfo,	PSB_YAMLDumper.represent_FileInfo)
+
+class	PSB_YAMLLoader(yaml.SafeLoader):
+	def	construct_TypeValue(self, node):
+		d = self.construct_mapping(node, deep=True)
+		return TypeValue(d['t'], d['v'])
+
+	def	construct_NameObject(self, node):
+		d = self.construct_mapping(node, deep=True)
+		return NameObject(d['ni'], d['o'])
+
+	def	construct_String(self, node):
+		d = self.construct_mapping(node, deep=True)
+		return String(d['t'], d['v'])
+
+	def	construct_FileInfo(self, node):
+		d = self.construct_mapping(node, deep=True)
+		return FileInfo(d['ni'], d['l'], d['o'])
+
+PSB_YAMLLoader.add_constructor(u'!TV',	PSB_YAMLLoader.construct_TypeValue)
+PSB_YAMLLoader.add_constructor(u'!NO',	PSB_YAMLLoader.construct_NameObject)
+PSB_YAMLLoader.add_constructor(u'!STR',	PSB_YAMLLoader.construct_String)
+PSB_YAMLLoader.add_constructor(u'!FI',	PSB_YAMLLoader.construct_FileInfo)
+
+#
+# Flags for the containers in the entries tree, see PSB.unpack_object
+#
+ENTRY_ROOT		= 1	# The root of the entries tree
+ENTRY_FILE_INFO		= 2	# The root's file_info list
+ENTRY_IN_FILE_INFO	= 4	# Inside the file_info list
+
+#
+# A type 32/33 container which is decoded from the PSB data on the first access of .v
+#
+# Until then, the object is unmodified and its packed bytes are still in the PSB data,
+# so pack_object copies them instead of re-encoding the subtree.
+#
+# Reading .v marks the object as dirty, the same as assigning it.
+# We can't see in-place changes to the list or to the values in it, so once the caller has the list
+# we have to assume it was changed, and the subtree is re-encoded when packing.
+# Any child can only be reached by decoding its parents, so the dirty flag propagates up to the root.
+#
+# To inspect the tree without losing the copy-through, check is_decoded() before reading .v.
+# repr() does not decode the object.
+#
+class	LazyObject(TypeValue):
+	__slots__ = ('_psb', '_offset', '_name', '_flags', '_v', '_end')
+	def	__init__(self, psb, offset, name, flags = 0):
+		self.t		= psb.psb_data[offset]
+		self._end	= None	# The end of the packed bytes, 0 if they can't be copied (see packed_data)
+		self._psb	= psb
+		self._offset	= offset
+		self._name	= name	# For debugging, the path of this object
+		self._flags	= flags	# For unpack_object, ENTRY_ROOT if this is the root of the entries tree
+		self._v		= None
+
+	@property
+	def	v(self):
+		if self._psb:
+			unpacker = buffer_unpacker(self._psb.psb_data)
+			unpacker.seek(self._offset)
+			self._v = self._psb.unpack_object(unpacker, self._name, self._flags, seek_end = False).v
+			self._psb = None
+		return self._v
+
+	@v.setter
+	def	v(self, v):
+		self._v = v
+		self._psb = None
+
+	# Show the object without decoding it
+	def	__repr__(self):
+		if self._psb:
+			return "%s(t=%r, offset=0x%X)" % (self.__class__.__name__, self.t, self._offset)
+		return "%s(t=%r, v=%r)" % (self.__class__.__name__, self.t, self._v)
+
+	def	is_decoded(self):
+		return self._psb is None
+
+	# Decode this object (but not its children)
+	def	decode(self):
+		return self.v
+
+	#
+	# Get the packed bytes of this object, while it is not decoded.
+	# Returns None if we can't tell where the bytes end, because the offsets of a container are not in order.
+	#
+	def	packed_data(self):
+		if self._end is None:
+			unpacker = buffer_unpacker(self._psb.psb_data)
+			unpacker.seek(self._offset)
+			if self._psb.skip_object(unpacker):
+				self._end = unpacker.tell()
+			else:
+				self._end = 0
+		if not self._end:
+			return None
+		return self._psb.psb_data[self._offset : self._end]
+
+	# Check if this object is unmodified, and its packed bytes can be copied when packing
+	def	is_clean(self):
+		return self._psb is not None and self.packed_data() is not None
+
+#
+# Check if obj is a type 32/33 container which needs encoding.
+# An unmodified LazyObject is copied as-is (see LazyObject.packed_data).
+#
+def	is_dirty_container(obj):
+	return obj.t in (32, 33) and not (isinstance(obj, LazyObject) and obj.is_clean())
+
+#
+# Get the number of nested type 32/33 containers in the tree, without recursion
+#
+def	get_tree_depth(obj):
+	depth = 0
+	stack = [(obj, 1)]
+	while stack:
+		obj, level = stack.pop()
+		if obj is None or obj.t not in (32, 33):
+			continue
+		depth = max(depth, level)
+		for o in obj.v:
+			stack.append((o.o if obj.t == 33 else o, level + 1))
+	return depth
+
 #
 # get the size of an int in bytes
 #
@@ -67,17 +226,114 @@ def	getUnsignedIntSize(v):
 		if v < (1 << (8 * s -1)):
 			return s
 
+#
+# get the packed size of an array of ints (type 13-20)
+#
+def	getIntArraySize(values):
+	count = len(values)
+	if count:
+		max_value = max(values)
+	else:
+		max_value = 0
+	# type + count + size of entries + entries
+	return 1 + getIntSize(count) + 1 + count * getIntSize(max_value)
+
+#
+# Bulk encode/decode of arrays of little-endian ints (the entries of type 13-20).
+#
+# Entries of 3, 5, 6 or 7 bytes are widened to the next native size (4 or 8 bytes)
+# by interleaving zero bytes, so the whole array is converted in one operation.
+#
+int_array_formats = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+int_array_widths  = [None, 1, 2, 4, 4, 8, 8, 8, 8]
+
+# Decode the array of ints in data, each size bytes, into a list
+def	unpack_int_array(data, size):
+	if size < 1 or size > 8 or len(data) % size:
+		return [int.from_bytes(data[i : i + size], 'little') for i in range(0, len(data), size)]
+
+	count = len(data) // size
+	width = int_array_widths[size]
+
+	if numpy is not None:
+		entries = numpy.frombuffer(data, dtype=numpy.uint8).reshape(count, size)
+		if size != width:
+			padded = numpy.zeros((count, width), dtype=numpy.uint8)
+			padded[:, : size] = entries
+			entries = padded
+		return entries.view('<u%d' % width).ravel().tolist()
+
+	if size != width:
+		padded = bytearray(count * width)
+		for i in range(size):
+			padded[i :: width] = data[i :: size]
+		data = padded
+
+	if sys.byteorder == 'little':
+		return memoryview(data).cast(int_array_formats[width]).tolist()
+	return list(struct.unpack('<%d%s' % (count, int_array_formats[width]), data))
+
+# Encode the list of ints into an array of size byte entries
+def	pack_int_array(values, size):
+	if size < 1 or size > 8:
+		return b''.join(v.to_bytes(size, 'little') for v in values)
+
+	count = len(values)
+	width = int_array_widths[size]
+
+	if numpy is not None:
+		entries = numpy.array(values, dtype='<u%d' % width).view(numpy.uint8).reshape(count, width)
+		return entries[:, : size].tobytes()
+
+	data = struct.pack('<%d%s' % (count, int_array_formats[width]), *values)
+	if size != width:
+		packed = bytearray(count * size)
+		for i in range(size):
+			packed[i :: size] = data[i :: width]
+		data = packed
+	return data
+
+#
+# Precompiled structs for the fixed size values
+#
+struct_u8	= struct.Struct('<B')
+struct_u32	= struct.Struct('<I')
+struct_f32	= struct.Struct('<f')
+struct_f64	= struct.Struct('<d')
+
 class	buffer_packer():
 	def __init__(self):
-		self._buffer = []
+		self._buffer = bytearray()
 		self._offset = 0	# points to the *next* byte to write
 
 	def __call__(self, fmt, data):
-		packed_data = struct.pack(fmt, data)
-		packed_length = len(packed_data)
-		self.setlength(self._offset + packed_length)
-		self._buffer[self._offset : self._offset + packed_length] = packed_data
-		self._offset += packed_length
+		self.write_bytes(struct.pack(fmt, data))
+
+	def	write_bytes(self, packed_data):
+		if self._offset == len(self._buffer):
+			# Appending, let the bytearray grow itself
+			self._buffer += packed_data
+		else:
+			packed_length = len(packed_data)
+			self.setlength(self._offset + packed_length)
+			self._buffer[self._offset : self._offset + packed_length] = packed_data
+		self._offset += len(packed_data)
+
+	# Typed writers, using our precompiled structs
+	def	write_u8(self, v):
+		self.write_bytes(struct_u8.pack(v))
+
+	def	write_u32(self, v):
+		self.write_bytes(struct_u32.pack(v))
+
+	def	write_uint(self, v, size):
+		self.write_bytes(v.to_bytes(size, 'little'))
+
+	def	write_f32(self, v):
+		self.write_bytes(struct_f32.pack(v))
+
+	def	write_f64(self, v):
+		self.write_bytes(struct_f64.pack(v))
 
 	def	length(self):
 		return len(self._buffer)
@@ -88,11 +344,20 @@ class	buffer_packer():
 
 	def	setlength(self, length):
 		if len(self._buffer) < length:
-			self._buffer = self._buffer + [0] * (length - len(self._buffer))
+			self._buffer += bytes(length - len(self._buffer))
 
 	def	tell(self):
 		return self._offset
 
+	# Get a memoryview of the packed data without copying it.
+	# The view must be released before packing any more data.
+	def	getbuffer(self):
+		return memoryview(self._buffer)
+
+	# Get a copy of the packed data
+	def	getvalue(self):
+		return bytes(self._buffer)
+
 
 '''
 <	Little endian
@@ -105,9 +370,14 @@ L	unsigned 4 bytes
 Q	unsigned 8 bytes
 '''
 
+#
+# The unpacker works on a memoryview of the buffer, so data(), read_bytes() etc
+# return slices of the original buffer without copying.
+# Use get_bytes() (or bytes()) to get an owned copy.
+#
 class	buffer_unpacker():
 	def __init__(self, buffer):
-		self._buffer = buffer
+		self._buffer = memoryview(buffer)
 		self._offset = 0
 
 	def __call__(self, fmt):
@@ -115,6 +385,53 @@ class	buffer_unpacker():
 		self._offset += struct.calcsize(fmt)
 		return result
 
+	# Typed readers, using our precompiled structs
+	def	read_bytes(self, size):
+		if self._offset + size > len(self._buffer):
+			raise struct.error("unpack requires a buffer of %d bytes" % size)
+		data = self._buffer[self._offset : self._offset + size]
+		self._offset += size
+		return data
+
+	def	read_u8(self):
+		v = struct_u8.unpack_from(self._buffer, self._offset)[0]
+		self._offset += 1
+		return v
+
+	def	read_u32(self):
+		v = struct_u32.unpack_from(self._buffer, self._offset)[0]
+		self._offset += 4
+		return v
+
+	def	read_uint(self, size):
+		return int.from_bytes(self.read_bytes(size), 'little')
+
+	def	read_f32(self):
+		v = struct_f32.unpack_from(self._buffer, self._offset)[0]
+		self._offset += 4
+		return v
+
+	def	read_f64(self):
+		v = struct_f64.unpack_from(self._buffer, self._offset)[0]
+		self._offset += 8
+		return v
+
+	# Read an int object (type 4-12)
+	def	read_int(self):
+		t = self.read_u8()
+		return self.read_uint(t - 4)
+
+	# Read an array of ints object (type 13-20)
+	def	read_int_array(self):
+		size_count = self.read_u8() - 12
+		count = self.read_uint(size_count)
+		size_entries = self.read_u8() - 12
+		return unpack_int_array(self.read_bytes(count * size_entries), size_entries)
+
+	# Get the next byte without moving the offset
+	def	peek_u8(self):
+		return struct_u8.unpack_from(self._buffer, self._offset)[0]
+
 	def	seek(self, offset):
 		if offset >= 0 and offset < len(self._buffer):
 			self._offset = offset
@@ -129,6 +446,10 @@ class	buffer_unpacker():
 	def	data(self):
 		return self._buffer[self._offset : ]
 
+	# Get a copy of the data between start and end
+	def	get_bytes(self, start, end):
+		return self._buffer[start : end].tobytes()
+
 	# Get the next output without moving the offset
 	def	peek(self, fmt):
 		off = self.tell()
@@ -147,7 +468,23 @@ class	buffer_unpacker():
 			if self._buffer[next0] == 0:
 				s = self._buffer[self._offset : next0]
 				self._offset = next0 + 1
-				return s.decode('utf-8')
+				return str(s, 'utf-8')
+
+#
+# A minimal read-only file object over an in-memory buffer.
+# read() returns memoryview slices, so nothing is copied.
+#
+class	buffer_reader():
+	def __init__(self, buffer):
+		self._buffer = memoryview(buffer)
+		self._offset = 0
+
+	def	read(self, size = -1):
+		if size is None or size < 0:
+			size = len(self._buffer) - self._offset
+		data = self._buffer[self._offset : self._offset + size]
+		self._offset += len(data)
+		return data
 
 # mdf\0
 # PSB\0
@@ -159,13 +496,13 @@ class	HDRLEN():
 		self.length		= 0
 
 	def	pack(self, packer):
-		packer('>4s',	self.signature)
-		packer('<I',	self.length)
+		packer.write_bytes(bytes(self.signature))
+		packer.write_u32(self.length)
 
 	def	unpack(self, unpacker):
 		self.offset0		= unpacker.tell()
-		self.signature		= unpacker('>4s')[0]
-		self.length		= unpacker('<I')[0]
+		self.signature		= bytes(unpacker.read_bytes(4))
+		self.length		= unpacker.read_u32()
 		self.offset1		= unpacker.tell()
 
 
@@ -188,6 +525,9 @@ struct PSBHDR {
 
 '''
 
+# Padding for the subfiles in alldata.bin
+bin_padding = bytes(0x800)
+
 class	PSB():
 	def	__init__(self):
 		self.header		= PSB_HDR()
@@ -203,12 +543,29 @@ class	PSB():
 		self.raw_chunk_data		= None
 
 		self.names		= []	# list of strings indexed by NameObject.ni
+		self.file_info_ni	= None	# index of 'file_info' in names[]
 		self.strings		= [] 	# list of strings index by Type 21-24
+		self.string_index	= {}	# dict of string -> index into strings, see add_string
 		self.chunkdata		= []	# raw data indexed by Type 25-28
 		self.chunknames		= []	# CNNNN filenames for each chunk
 		self.entries		= None
+		self.lazy		= False	# Decode the entries containers on demand (see LazyObject)
+		self.psb_data		= None	# The data we unpacked, for decoding LazyObjects
 		self.fileinfo		= []	# Stash of FileInfo objects (easier than walking the entries tree)
+		self.fileinfo_fields	= []	# For each FileInfo, the (position, size) of its offset & length ints in raw_entries
+		self.fileinfo_changed	= False	# The FileInfo no longer matches raw_entries, see patch_fileinfo
+		self.fileinfo_index	= {}	# dict of subfile path -> index into fileinfo, see build_fileinfo_index
+		self.fileinfo_paths	= []	# sorted list of subfile paths, for prefix/glob lookups
+		self.rom_index		= None	# index into fileinfo of the first 'system/roms' file
+		self.indexed_fileinfo	= (None, 0)	# the fileinfo list (and its length) the index was built from
 		self.subfile_data	= None	# Copy of each subfile from ADB in encrypted/compressed form
+		self.bin_filename	= None	# The alldata.bin file mapped by map_subfiles
+		self.bin_file		= None	# The open file object of bin_filename
+		self.bin_map		= None	# The mmap of bin_filename
+		self.bin_offsets	= []	# The offset of each subfile in bin_filename
+		self.fixed_layout	= False	# Keep the FileInfo offsets, see patch_subfile
+		self.slot_lengths	= {}	# For the fixed layout, dict of subfile index -> length of its old slot
+		self.template		= None	# The PSB we were cloned from, which owns bin_map, see clone
 
 	def	__str__(self):
 		o = "PSB:\n"
@@ -251,10 +608,14 @@ class	PSB():
 		packer.seek(0)
 		self.header.pack(packer)
 
-		return bytes(packer._buffer)
+		return packer.getvalue()
 
-	def	unpack(self, psb_data):
+	# If lazy is set, the entries tree is only decoded when it is accessed.
+	# The fileinfo is found with scan_fileinfo instead.
+	def	unpack(self, psb_data, lazy = False):
 		unpacker = buffer_unpacker(psb_data)
+		self.lazy	= lazy
+		self.psb_data	= unpacker.data()
 
 		if global_vars.verbose >= global_vars.trace_level:
 			print("Parsing header:")
@@ -283,7 +644,53 @@ class	PSB():
 		# Read in our tree of entries
 		self.unpack_entries(unpacker)
 
+	# Only read in the header, names and fileinfo.
+	# This is enough to extract subfiles, but not to pack the PSB.
+	def	unpack_fileinfo(self, psb_data):
+		unpacker = buffer_unpacker(psb_data)
+		self.psb_data = unpacker.data()
+
+		self.header.unpack(unpacker)
+		if self.header.signature != b'PSB\x00':
+			return
+
+		self.unpack_names(unpacker)
+		self.scan_fileinfo(unpacker)
+
+	# Decode any LazyObjects in the entries tree
+	def	decode_entries(self):
+		self.entries = self.decode_object(self.entries)
+
+	#
+	# Get a copy of the tree with every LazyObject decoded.
+	# This uses an explicit stack instead of recursion, as unpack_object does.
+	#
+	def	decode_object(self, obj):
+		if obj.t not in (32, 33):
+			return obj
+
+		top = TypeValue(obj.t, [])
+		stack = [(obj, top)]
+		while stack:
+			obj, decoded = stack.pop()
+			for o in obj.v:
+				child = o.o if obj.t == 33 else o
+				if child.t in (32, 33):
+					decoded_child = TypeValue(child.t, [])
+					stack.append((child, decoded_child))
+				else:
+					decoded_child = child
+				if obj.t == 33:
+					decoded.v.append(NameObject(o.ni, decoded_child))
+				else:
+					decoded.v.append(decoded_child)
+		return top
+
 	def	print_yaml(self):
+		# YAML needs the fully decoded tree
+		if self.entries and self.lazy:
+			self.decode_entries()
+
 		# Create a top-level dict to dump
 		level0 = {
 			'raw_names':		self.raw_names,
@@ -299,11 +706,19 @@ class	PSB():
 			'entries':	self.entries,
 			'fileinfo':	self.fileinfo,
 		}
-		return yaml.dump(level0)
+		# Give the dumper our names/strings
+		dumper = type('PSB_YAMLDumper', (PSB_YAMLDumper,), {'psb': self})
+
+		# The YAML dumper recurses (several calls per level), make sure it can reach our deepest container
+		recursion_limit = sys.getrecursionlimit()
+		sys.setrecursionlimit(max(recursion_limit, 1000 + 10 * get_tree_depth(self.entries)))
+		try:
+			return yaml.dump(level0, Dumper=dumper)
+		finally:
+			sys.setrecursionlimit(recursion_limit)
 
 	def	load_yaml(self, data):
-		# FIXME - use yaml.safe_load
-		level0 = yaml.load(data)
+		level0 = yaml.load(data, Loader=PSB_YAMLLoader)
 		if isinstance(level0, dict):
 			self.raw_names			= level0['raw_names']
 			self.raw_entries		= level0['raw_entries']
@@ -315,9 +730,17 @@ class	PSB():
 
 			self.names		= level0['names']
 			self.strings		= level0['strings']
+			self.build_string_index()
 			self.chunknames		= level0['chunknames']
 			self.entries		= level0['entries']
 			self.fileinfo		= level0['fileinfo']
+			self.build_fileinfo_index()
+
+			# Find the FileInfo fields in the raw entries, so we can patch them
+			if 'file_info' in self.names:
+				self.file_info_ni = self.names.index('file_info')
+			if self.raw_entries:
+				self.fileinfo_fields = self.locate_fileinfo(self.raw_entries)[1]
 
 	# Read in our chunk files
 	def	read_chunks(self, base_dir):
@@ -346,6 +769,10 @@ class	PSB():
 
 	# Update our FileInfo offset/lengths
 	def	update_fileinfo(self):
+		if self.fixed_layout:
+			# The subfiles have been patched into their old slots, our FileInfo is current
+			return
+
 		assert(len(self.subfile_data) == len(self.fileinfo))
 		offset = 0
 		for i, fi in enumerate(self.fileinfo):
@@ -360,14 +787,14 @@ class	PSB():
 					print("File '%s' length differs, re-writing entries table" % self.names[fi.ni])
 					print("Old length %d 0x%X" % (fi.l, fi.l))
 					print("New length %d 0x%X" % (new_length, new_length))
-				# Clear the cached entries block
-				self.raw_entries = None
+				# Patch the cached entries block when packing
+				self.fileinfo_changed = True
 
 			# If our offset has changed, we need to rewrite the entries section
 			if offset != fi.o:
 				# Don't warn about this, they could all be different
-				# Clear the cached entries block
-				self.raw_entries = None
+				# Patch the cached entries block when packing
+				self.fileinfo_changed = True
 
 			# Update the PSB's FileInfo with the new length, offset
 			# The FileInfo holds the unpadded length
@@ -381,32 +808,117 @@ class	PSB():
 			# Advance our running offset by the padded length
 			offset += new_length
 
+	# Get the length of the slot for subfile i in alldata.bin (the length padded to 0x800 bytes)
+	# Once the subfile has been fitted into its old slot, this is the length of the old slot.
+	def	get_slot_length(self, i):
+		if i in self.slot_lengths:
+			return self.slot_lengths[i]
+		length = self.fileinfo[i].l
+		if length % 0x800:
+			length += 0x800 - (length % 0x800)
+		return length
+
+	# Check if the subfile_data entry for subfile i fits in its old slot in alldata.bin
+	def	subfile_fits(self, i):
+		return len(self.subfile_data[i]) <= self.get_slot_length(i)
+
+	#
+	# Keep subfile i in its old slot in alldata.bin, and record its new length in the FileInfo.
+	#
+	# The offsets of every subfile stay the same, so from now on we keep the layout (see update_fileinfo).
+	# If the length has changed, the FileInfo is patched into the entries when packing.
+	#
+	def	keep_subfile_slot(self, i):
+		assert(self.subfile_fits(i))
+		fi = self.fileinfo[i]
+		fd = self.subfile_data[i]
+
+		self.slot_lengths.setdefault(i, self.get_slot_length(i))
+		self.fixed_layout = True
+		if fi.l != len(fd):
+			if global_vars.verbose >= global_vars.trace_level:
+				print("File '%s' length differs, patching entries table" % self.names[fi.ni])
+				print("Old length %d 0x%X" % (fi.l, fi.l))
+				print("New length %d 0x%X" % (len(fd), len(fd)))
+			fi.l = len(fd)
+			self.fileinfo_changed = True
+
+	#
+	# Write subfile i over its old slot in the alldata.bin file object f, and clear the rest of the slot.
+	# See keep_subfile_slot.
+	#
+	def	patch_subfile(self, f, i):
+		self.keep_subfile_slot(i)
+		fi = self.fileinfo[i]
+		fd = self.subfile_data[i]
+
+		f.seek(fi.o)
+		f.writelines([fd, bytes(self.get_slot_length(i) - len(fd))])
+
 	# Join our subfile data array into a single alldata.bin array
 	def	join_subfiles(self):
 		if not self.fileinfo:
 			return
 
+		return bytearray(b''.join(self.iter_bin_blocks()))
+
+	# Write our subfiles into the alldata.bin file object f, without joining them in memory.
+	# Returns False if we have no subfiles.
+	#
+	# The subfiles we have not modified are copied from the mapped alldata.bin file by copy_file_data,
+	# so their data does not pass through python. The rest are written from our subfile_data.
+	#
+	def	write_subfiles(self, f):
+		if not self.fileinfo:
+			return False
+
+		blocks = []
+		for i, fd, padding in self.iter_bin_subfiles():
+			if self.is_mapped_subfile(i):
+				# Write what we have so far, and copy the subfile from the original file
+				f.writelines(blocks)
+				blocks = []
+				copy_file_data(self.bin_file, self.bin_offsets[i], len(fd), f)
+			else:
+				blocks.append(fd)
+			if padding:
+				blocks.append(padding)
+		f.writelines(blocks)
+		return True
+
+	# Yield the blocks of data for the alldata.bin file: each subfile followed by its padding.
+	def	iter_bin_blocks(self):
+		for i, fd, padding in self.iter_bin_subfiles():
+			yield fd
+			if padding:
+				yield padding
+
+	#
+	# Yield (index, data, padding) for each subfile in the alldata.bin file.
+	# This updates our FileInfo offsets/lengths first, and checks each subfile lands at its offset.
+	#
+	def	iter_bin_subfiles(self):
 		self.update_fileinfo()
 
-		bin_data	= []
+		offset = 0
 		for i, fi in enumerate(self.fileinfo):
+			assert(fi.o == offset)
 
-			# Take a copy of the data (so we don't pad the entry in subfile_data)
-			fd = self.subfile_data[i][:]
+			# The data may be a view of the mapped alldata.bin
+			fd = self.subfile_data[i]
 
 			# Get the unpadded length
 			new_length = len(fd)
 
 			# Pad the data to a multiple of 0x800 bytes
+			padding = b''
 			if new_length % 0x800:
-				fd += b'\x00' * (0x800 - new_length % 0x800)
+				padding = bin_padding[ : 0x800 - new_length % 0x800]
 			if global_vars.verbose >= global_vars.trace_level:
-				print("Padded length %d 0x%X" % (len(fd), len(fd)))
-
-			# Add the self.subfile to the ADB array
-			bin_data.extend(fd)
+				print("Padded length %d 0x%X" % (new_length + len(padding), new_length + len(padding)))
 
-		return bin_data
+			yield i, fd, padding
+			offset += new_length + len(padding)
 
 	# Read in all our subfiles into a subfile_data array.
 	# The data is compressed/encrypted
@@ -431,12 +943,11 @@ class	PSB():
 
 	# Replace the subfile_data entry for the first 'system/roms' file with the given rom data
 	def	replace_rom_file(self, fd):
-		for i, fi in enumerate(self.fileinfo):
-			if 'system/roms' in self.names[fi.ni]:
-				if global_vars.verbose >= global_vars.info_level:
-					print("Replacing '%s'" % self.names[fi.ni])
-				self.replace_subfile(i, fd)
-				break
+		i = self.get_rom_index()
+		if i is not None:
+			if global_vars.verbose >= global_vars.info_level:
+				print("Replacing '%s'" % self.names[self.fileinfo[i].ni])
+			self.replace_subfile(i, fd)
 
 	# Compress/Encrypt and save the given data for a single subfile.
 	def	replace_subfile(self, i, fd0):
@@ -449,15 +960,16 @@ class	PSB():
 		if self.names[fi.ni].endswith('.psb') or self.names[fi.ni].endswith('.psb.m'):
 			fd2 = fd0[:]
 		else:
-			# Compress the data
 			if self.names[fi.ni].endswith('.jpg.m'):
 				# JPEG files are stored with minimal compression
-				fd1 = compress_data(fd0, 0)
+				level = 0
 			else:
-				fd1 = compress_data(fd0, 9)
+				level = 9
 
-			# Obfuscate the data using the original filename for the seed
-			fd2 = unobfuscate_data(fd1, self.names[fi.ni])
+			# Compress the data, and obfuscate it using the original filename for the seed
+			fd2 = bytearray()
+			for data in compress_stream(fd0, self.names[fi.ni], level):
+				fd2 += data
 
 		if global_vars.verbose >= global_vars.trace_level:
 			print("Compressed length %d 0x%X" % (len(fd2), len(fd2)))
@@ -474,8 +986,8 @@ class	PSB():
 				print("File '%s' length differs, re-writing entries table" % self.names[fi.ni])
 				print("Old length %d 0x%X" % (fi.l, fi.l))
 				print("New length %d 0x%X" % (new_length, new_length))
-			# Clear the cached entries block
-			self.raw_entries = None
+			# Patch the cached entries block when packing
+			self.fileinfo_changed = True
 
 
 	# Split our subfiles
@@ -494,20 +1006,176 @@ class	PSB():
 			# Add the chunk to our array
 			self.subfile_data.append(fd)
 
+	#
+	# Split our subfiles from a memory map of the alldata.bin file.
+	#
+	# Each subfile_data entry is a view of its range of the mapped file,
+	# so subfiles we don't modify are never read into memory (unless they are used).
+	# The mapping stays open until unmap_subfiles, or until the last view is released.
+	#
+	# We keep the file open, so write_subfiles can copy the unmodified subfiles straight from it.
+	#
+	def	map_subfiles(self, bin_filename):
+		f = open(bin_filename, 'rb')
+		try:
+			self.bin_map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		except ValueError:
+			# Empty file, can't be mapped
+			self.split_subfiles(f.read())
+			f.close()
+			return
+		self.bin_filename	= bin_filename
+		self.bin_file		= f
+		self.split_subfiles(memoryview(self.bin_map))
+		self.bin_offsets	= [fi.o for fi in self.fileinfo]
+
+	# Check if subfile i is still the view of the mapped alldata.bin (it has not been replaced)
+	def	is_mapped_subfile(self, i):
+		fd = self.subfile_data[i]
+		return self.bin_map is not None and isinstance(fd, memoryview) and fd.obj is self.bin_map
+
+	#
+	# Copy any subfiles which are views of the mapped alldata.bin into memory, and release the mapping.
+	# This is needed before over-writing the mapped file.
+	#
+	def	unmap_subfiles(self):
+		if self.bin_map is None:
+			return
+		if self.subfile_data:
+			self.subfile_data = [bytearray(fd) if isinstance(fd, memoryview) else fd for fd in self.subfile_data]
+		try:
+			if self.template is None:
+				self.bin_map.close()
+		except BufferError:
+			# Something still has a view, the mapping is closed when it is released
+			pass
+		if self.template is None:
+			self.bin_file.close()
+		self.bin_map		= None
+		self.bin_file		= None
+		self.bin_filename	= None
+		self.bin_offsets	= []
+
+	#
+	# Make a copy of this PSB to modify, using this PSB as a read-only template.
+	#
+	# The copy shares the names, strings, chunks, the raw sections and the mapped alldata.bin with this PSB.
+	# Only the parts we modify when injecting are copied: the FileInfo, the subfile_data list and the file_info list.
+	# Replacing subfiles in the copy and packing it does not change this PSB.
+	#
+	# This PSB must stay mapped while the copy is in use, the copy does not close the mapping.
+	#
+	def	clone(self):
+		mypsb = copy.copy(self)
+		mypsb.header		= copy.copy(self.header)
+		mypsb.fileinfo		= [FileInfo(fi.ni, fi.l, fi.o) for fi in self.fileinfo]
+		mypsb.fileinfo_fields	= list(self.fileinfo_fields)
+		mypsb.indexed_fileinfo	= (mypsb.fileinfo, len(mypsb.fileinfo))
+		mypsb.slot_lengths	= dict(self.slot_lengths)
+		mypsb.strings		= list(self.strings)
+		mypsb.string_index	= dict(self.string_index)
+		if self.subfile_data is not None:
+			mypsb.subfile_data = list(self.subfile_data)
+		if self.bin_map is not None:
+			mypsb.template = self.template or self
+
+		if isinstance(self.entries, LazyObject) and not self.entries.is_decoded():
+			# Decode the copy's root on demand into the copy (this re-populates its fileinfo)
+			mypsb.entries = LazyObject(mypsb, self.entries._offset, self.entries._name, self.entries._flags)
+		elif self.entries is not None and self.entries.t == 33:
+			# pack_object re-populates the file_info list, so the copy needs its own root and file_info list
+			mypsb.entries = TypeValue(33, [NameObject(no.ni, TypeValue(33, [])) if no.ni == self.file_info_ni else no for no in self.entries.v])
+		return mypsb
+
 	# Extract the subfile_data entry for the first 'system/roms' file.
 	# The file data is unencrypted/uncompressed.
 	def	extract_rom(self):
-		for i, fi in enumerate(self.fileinfo):
-			if 'system/roms' in self.names[fi.ni]:
-				return self.subfile_data[i][:]
+		i = self.get_rom_index()
+		if i is not None:
+			return self.subfile_data[i][:]
 
 	def	write_rom_file(self, filename):
+		i = self.get_rom_index()
+		if i is not None:
+			if global_vars.verbose >= global_vars.info_level:
+				print("Extracting '%s'" % self.names[self.fileinfo[i].ni])
+			self.write_subfile(i, filename)
+
+	#
+	# Index of our subfiles by path.
+	#
+	# This is built when we unpack the fileinfo, and rebuilt on lookup if self.fileinfo has been replaced or extended.
+	# The FileInfo offsets/lengths can change, but the paths (and their order) do not.
+	#
+	def	build_fileinfo_index(self):
+		self.fileinfo_index	= {}
+		self.rom_index		= None
 		for i, fi in enumerate(self.fileinfo):
-			if 'system/roms' in self.names[fi.ni]:
-				if global_vars.verbose >= global_vars.info_level:
-					print("Extracting '%s'" % self.names[fi.ni])
-				self.write_subfile(i, filename)
-				break
+			path = self.names[fi.ni]
+			self.fileinfo_index.setdefault(path, i)
+			if self.rom_index is None and 'system/roms' in path:
+				self.rom_index = i
+		self.fileinfo_paths	= sorted(self.fileinfo_index)
+		self.indexed_fileinfo	= (self.fileinfo, len(self.fileinfo))
+
+	def	check_fileinfo_index(self):
+		if self.indexed_fileinfo[0] is not self.fileinfo or self.indexed_fileinfo[1] != len(self.fileinfo):
+			self.build_fileinfo_index()
+
+	# Get the index into fileinfo of the first 'system/roms' file
+	def	get_rom_index(self):
+		self.check_fileinfo_index()
+		return self.rom_index
+
+	# Get the index into fileinfo of the subfile with the exact path, or None
+	def	get_subfile_index(self, path):
+		self.check_fileinfo_index()
+		return self.fileinfo_index.get(path)
+
+	# Get the FileInfo of the subfile with the exact path, or None
+	def	get_subfile(self, path):
+		i = self.get_subfile_index(path)
+		if i is None:
+			return None
+		return self.fileinfo[i]
+
+	# Compress/Encrypt and save the given data for the subfile with the exact path.
+	# Returns the subfile's FileInfo, or None if there is no such subfile.
+	def	replace_subfile_by_path(self, path, fd):
+		i = self.get_subfile_index(path)
+		if i is None:
+			if global_vars.verbose >= global_vars.info_level:
+				print("File '%s' not found" % path)
+			return None
+		self.replace_subfile(i, fd)
+		return self.fileinfo[i]
+
+	#
+	# Yield (index into fileinfo, path) for each subfile matching the pattern, in fileinfo order.
+	#
+	# The pattern is either a glob (containing any of *?[), or a path prefix such as 'image/' for everything below image.
+	# With no pattern, every subfile is returned.
+	#
+	def	iter_subfiles(self, pattern = None):
+		self.check_fileinfo_index()
+		if pattern is None:
+			pattern = ''
+
+		# Find the range of sorted paths starting with the literal part of the pattern
+		glob_start = min([pattern.find(c) for c in '*?[' if c in pattern] + [len(pattern)])
+		prefix = pattern[ : glob_start]
+		first = bisect.bisect_left(self.fileinfo_paths, prefix)
+		last = first
+		while last < len(self.fileinfo_paths) and self.fileinfo_paths[last].startswith(prefix):
+			last += 1
+		paths = self.fileinfo_paths[first : last]
+
+		# Filter by the glob
+		if glob_start < len(pattern):
+			paths = [path for path in paths if fnmatch.fnmatchcase(path, pattern)]
+
+		for i in sorted(self.fileinfo_index[path] for path in paths):
+			yield i, self.names[self.fileinfo[i].ni]
 
 	# Write out all our subfiles to their disk files.
 	# The file data is unencrypted/uncompressed.
@@ -533,43 +1201,96 @@ class	PSB():
 		if len(os.path.dirname(filename)):
 			os.makedirs(os.path.dirname(filename), exist_ok = True)
 
-		# Get a copy of the encrypted/compressed data from our array
-		fd2 = self.subfile_data[i][:]
+		# Get the encrypted/compressed data from our array
+		fd2 = self.subfile_data[i]
 		if global_vars.verbose >= global_vars.debug_level:
 			open(filename + '.2', 'wb').write(fd2)
 
-		# Compress the data
-		if self.names[fi.ni].endswith('.psb') or self.names[fi.ni].endswith('.psb.m'):
-			# Write out sub-psb files as-is
-			fd0 = fd2
-		else:
-			# Unobfuscate the data using the original filename for the seed
-			fd1 = unobfuscate_data(fd2, self.names[fi.ni])
-			if global_vars.verbose >= global_vars.debug_level:
-				open(filename + '.1', 'wb').write(fd1)
+		with open(filename, 'wb') as f:
+			if self.names[fi.ni].endswith('.psb') or self.names[fi.ni].endswith('.psb.m'):
+				# Write out sub-psb files as-is
+				f.write(fd2)
+			else:
+				# Unobfuscate the data using the original filename for the seed, and uncompress it
+				debug_fd = None
+				if global_vars.verbose >= global_vars.debug_level:
+					debug_fd = open(filename + '.1', 'wb')
 
-			# Uncompress the data
-			fd0 = uncompress_data(fd1)
+				for fd0 in uncompress_stream(buffer_reader(fd2), self.names[fi.ni], debug_fd = debug_fd):
+					f.write(fd0)
 
-		# Write out the subfile
-		open(filename, 'wb').write(fd0)
+				if debug_fd:
+					debug_fd.close()
 
 	#
 	# based on exm2lib get_number()
 	#
-	def	pack_object(self, packer, name, obj):
+	# Containers (type 32, 33) need the offsets of their children before the children,
+	# so we first measure the packed size of every container in the tree (see measure_object),
+	# then write each object straight into the packer.
+	# Both passes use an explicit stack instead of recursion, so deeply nested trees can be packed.
+	#
+	# name is only used for debugging output, and the paths of the children are only built when debugging.
+	# flags is ENTRY_ROOT for the root of the entries tree, or ENTRY_FILE_INFO for its file_info list,
+	# which is re-populated from our FileInfo (see measure_object).
+	#
+	def	pack_object(self, packer, name, obj, sizes = None, flags = 0):
+		if not is_dirty_container(obj):
+			self.pack_value(packer, obj)
+			return
+
+		if sizes is None:
+			sizes = {}
+			self.measure_object(name, obj, sizes, flags)
+
+		debug = global_vars.verbose >= global_vars.debug_level
+
+		stack = [(obj, name)]
+		while stack:
+			obj, path = stack.pop()
+			if not is_dirty_container(obj):
+				self.pack_value(packer, obj)
+				continue
+
+			packer.write_u8(obj.t)
+			if obj.t == 33:
+				# array of name/object pairs, written as array of name indexes, array of offsets, array of objects
+				self.pack_value(packer, TypeValue(13, [no.ni for no in obj.v]))
+				self.pack_value(packer, TypeValue(13, sizes[id(obj)][1]))
+				children = []
+				for no in obj.v:
+					child_path = None
+					if debug:
+						print("<<< %s %s" % (path, self.names[no.ni]))
+						child_path = "%s|%s" % (path, self.names[no.ni])
+					children.append((no.o, child_path))
+			else:
+				# array of objects, written as array of offsets (int), array of objects
+				self.pack_value(packer, TypeValue(13, sizes[id(obj)][1]))
+				children = [(o, None) for o in obj.v]
+
+			# Pack the objects, in order
+			stack.extend(reversed(children))
+
+	#
+	# Pack a single value (anything but a type 32/33 container which needs encoding)
+	#
+	def	pack_value(self, packer, obj):
 		t = obj.t
-		if t >= 1 and t <= 3:
-			packer('<B', t)
+		if isinstance(obj, LazyObject) and obj.is_clean():
+			# Unmodified, copy the packed bytes
+			packer.write_bytes(obj.packed_data())
+		elif t >= 1 and t <= 3:
+			packer.write_u8(t)
 		elif t >=4 and t <= 12:
 			# int, 0-8 bytes
 			v = obj.v
 			if v == 0:
-				packer('<B', 4)
+				packer.write_u8(4)
 			else:
 				s = getIntSize(v)
-				packer('<B', 4 + s)
-				packer('<%ds' % s, v.to_bytes(s, 'little'))
+				packer.write_u8(4 + s)
+				packer.write_uint(v, s)
 		elif t == 100:
 			# Internal only.
 			# unsigned int, 0-8 bytes
@@ -577,17 +1298,17 @@ class	PSB():
 			# Used when repacking the file_info offset, length fields
 			v = obj.v
 			if v == 0:
-				packer('<B', 4)
+				packer.write_u8(4)
 			else:
 				s = getUnsignedIntSize(v)
-				packer('<B', 4 + s)
-				packer('<%ds' % s, v.to_bytes(s, 'little'))
+				packer.write_u8(4 + s)
+				packer.write_uint(v, s)
 		elif t >= 13 and t <= 20:
 			# array of ints, packed as size of count, count, size of entries, entries[]
 			count = len(obj.v)
 			s = getIntSize(count)
-			packer('<B', 12 + s)
-			packer('<%ds' % s, count.to_bytes(s, 'little'))
+			packer.write_u8(12 + s)
+			packer.write_uint(count, s)
 			# Find our biggest value
 			if count:
 				max_value = max(obj.v)
@@ -595,258 +1316,357 @@ class	PSB():
 				max_value = 0
 			# Pack the number of bytes in each value
 			s = getIntSize(max_value)
-			packer('<B', s + 12)
-			# Pack each value
-			for v in obj.v:
-				packer('<%ds' % s, v.to_bytes(s, 'little'))
+			packer.write_u8(s + 12)
+			# Pack the values
+			packer.write_bytes(pack_int_array(obj.v, s))
 		elif t >= 21 and t <= 24:
 			# index into 'strings' array (1-4 bytes)
 			s = getIntSize(obj.v)
-			packer('<B', 20 + s)
-			packer('<%ds' % s, obj.v.to_bytes(s, 'little'))
+			packer.write_u8(20 + s)
+			packer.write_uint(obj.v, s)
 		elif t >= 25 and t <= 28:
 			# index into 'chunks' array, 1-4 bytes
 			s = getIntSize(obj.v)
-			packer('<B', 24 + s)
-			packer('<%ds' % s, obj.v.to_bytes(s, 'little'))
+			packer.write_u8(24 + s)
+			packer.write_uint(obj.v, s)
 		elif t == 29:
 			# 0 byte float
-			packer('<B', t)
+			packer.write_u8(t)
 		elif t == 30:
 			# 4 byte float
-			packer('<B', t)
-			packer('f', obj.v)
+			packer.write_u8(t)
+			packer.write_f32(obj.v)
 		elif t == 31:
 			# 8 byte float
-			packer('<B', t)
-			packer('d', obj.v)
-		elif t == 32:
-			# array of objects, written as array of offsets (int), array of objects
-			packer('<B', t)
-
-			# We need a list of offsets before the objects, so we have to pack each object into a temporary buffer to get the size
-			next_offset	= 0
-			temp_offsets	= []
-			temp_data	= []
-			for o in obj.v:
-				# Pack our object into a temporary buffer to get the size
-				temp_packer = buffer_packer()
-				self.pack_object(temp_packer, '', o)
-
-				# Remember our offset
-				temp_offsets.append(next_offset)
+			packer.write_u8(t)
+			packer.write_f64(obj.v)
+		else:
+			print("Unknown type")
+			print(t)
+			assert(False)
 
-				# Advance the next offset
-				next_offset += temp_packer.length()
+	#
+	# Get the packed size of an object.
+	# For each container we save (size, offsets of the children) in sizes[id(obj)] for pack_object.
+	# flags is as for pack_object, the root's file_info list is found by its name index.
+	#
+	# The containers are measured using an explicit stack, each frame is
+	# [object, path, flags, next child, offsets of the children so far, offset of the next child]
+	#
+	def	measure_object(self, name, obj, sizes, flags = 0):
+		if not is_dirty_container(obj):
+			return self.measure_value(obj)
+
+		debug = global_vars.verbose >= global_vars.debug_level
+
+		size = 0
+		stack = [self.measure_container(obj, name, flags)]
+		while stack:
+			frame = stack[-1]
+			obj, path, flags, i, offsets, next_offset = frame
+			if i == len(obj.v):
+				# We have measured all our children
+				stack.pop()
+				if obj.t == 33:
+					size = 1 + getIntArraySize([no.ni for no in obj.v]) + getIntArraySize(offsets) + next_offset
+				else:
+					size = 1 + getIntArraySize(offsets) + next_offset
+				sizes[id(obj)] = (size, offsets)
+				if stack:
+					stack[-1][5] += size
+				continue
+			frame[3] = i + 1
+
+			child_path	= None
+			child_flags	= 0
+			if obj.t == 33:
+				no = obj.v[i]
+				if (type(no) != NameObject):
+					print("Expected NameObject, got %s" % type(no))
+				child = no.o
+				if debug:
+					child_path = "%s|%s" % (path, self.names[no.ni])
+				if flags & ENTRY_ROOT and no.ni == self.file_info_ni:
+					child_flags = ENTRY_FILE_INFO
+			else:
+				child = obj.v[i]
 
-				# Remember our object data
-				temp_data.append(bytes(temp_packer._buffer))
+			offsets.append(next_offset)
+			if is_dirty_container(child):
+				stack.append(self.measure_container(child, child_path, child_flags))
+			else:
+				frame[5] = next_offset + self.measure_value(child)
 
-			# Pack the list of offsets
-			self.pack_object(packer, '', TypeValue(13, temp_offsets))
+		return size
 
-			# Pack the object data
-			for od in temp_data:
-				l = len(od)
-				packer('<%ds' % l, od)
-		elif t == 33:
-			# array of name/object pairs, written as array of name indexes, array of offsets, array of objects
-			packer('<B', t)
+	#
+	# Get the stack frame for measuring a container, see measure_object
+	#
+	def	measure_container(self, obj, path, flags):
+		# If the type33 is a "file_info", we ignore the list in the tree and re-populate it from the PSB.fileinfo[]
+		if obj.t == 33 and flags & ENTRY_FILE_INFO:
+			if global_vars.verbose >= global_vars.trace_level:
+				print("Packing fileinfo struct (%d entries)" % len(self.fileinfo))
+			# Make sure our offset/lengths are current
+			self.update_fileinfo()
 
-			# If the type33 is a "file_info", we ignore the list in the tree and re-populate it from the PSB.fileinfo[]
-			if name == '|file_info':
-				if global_vars.verbose >= global_vars.trace_level:
-					print("Packing fileinfo struct (%d entries)" % len(self.fileinfo))
-				# Make sure our offset/lengths are current
-				self.update_fileinfo()
-
-				obj.v=[]
-				for fi in self.fileinfo:
-					obj.v.append(NameObject(fi.ni, TypeValue(32, [TypeValue(100, fi.o), TypeValue(100, fi.l)]), self.names[fi.ni]))
-
-			# We need a list of offsets before the objects, so we have to pack each object into a temporary buffer to get the size
-			next_offset	= 0
-			temp_names	= []
-			temp_offsets	= []
-			temp_data	= []
-			for no in obj.v:
-				if (type(no) != NameObject):
-					print("Expected NameObject, got %s" % type(no))
-				if global_vars.verbose >= global_vars.debug_level:
-					print("<<< %s %s" % (name, self.names[no.ni]))
+			obj.v=[]
+			for fi in self.fileinfo:
+				obj.v.append(NameObject(fi.ni, TypeValue(32, [TypeValue(100, fi.o), TypeValue(100, fi.l)])))
 
-				# Pack our object into a temporary buffer to get the size
-				temp_packer = buffer_packer()
-				self.pack_object(temp_packer, name + "|%s" % self.names[no.ni], no.o)
+		return [obj, path, flags, 0, [], 0]
 
-				# Remember our name index
-				temp_names.append(no.ni)
+	#
+	# Get the packed size of a single value (anything but a type 32/33 container which needs encoding)
+	#
+	def	measure_value(self, obj):
+		t = obj.t
+		if isinstance(obj, LazyObject) and obj.is_clean():
+			return len(obj.packed_data())
+		elif (t >= 1 and t <= 3) or t == 29:
+			return 1
+		elif t >= 4 and t <= 12:
+			if obj.v == 0:
+				return 1
+			return 1 + getIntSize(obj.v)
+		elif t == 100:
+			if obj.v == 0:
+				return 1
+			return 1 + getUnsignedIntSize(obj.v)
+		elif t >= 13 and t <= 20:
+			return getIntArraySize(obj.v)
+		elif t >= 21 and t <= 28:
+			return 1 + getIntSize(obj.v)
+		elif t == 30:
+			return 1 + 4
+		elif t == 31:
+			return 1 + 8
+		else:
+			print("Unknown type")
+			print(t)
+			assert(False)
 
-				# Remember our offset
-				temp_offsets.append(next_offset)
+	#
+	# Move the unpacker to the end of the object without decoding it.
+	# This leaves the unpacker where unpack_object would, so for containers we only walk the child
+	# with the largest offset (the last child, if the offsets are in order).
+	#
+	# Returns False if the offsets of any container we walked are not in order. Then the object's bytes
+	# may not be laid out as we expect, and LazyObject decodes it rather than copying them.
+	#
+	def	skip_object(self, unpacker):
+		in_order = True
+		while unpacker.peek_u8() in (32, 33):
+			t = unpacker.read_u8()
+			if t == 33:
+				# Skip the names array
+				unpacker.read_int_array()
+			offsets = unpacker.read_int_array()
+			if not offsets:
+				return in_order
+			# The child at the largest offset ends the container, even if the offsets are not in order
+			if any(offsets[i] > offsets[i + 1] for i in range(len(offsets) - 1)):
+				in_order = False
+			unpacker.seek(unpacker.tell() + max(offsets))
+		self.unpack_value(unpacker, '')
+		return in_order
 
-				# Advance the next offset
-				next_offset += temp_packer.length()
+	#
+	# Unpack the object at the unpacker's offset.
+	#
+	# Containers (type 32, 33) are decoded using an explicit stack instead of recursion.
+	# name is only used for debugging output, and the paths of the children are only built when debugging.
+	# flags is ENTRY_ROOT for the root of the entries tree, so we can find its file_info list by name index.
+	#
+	# In lazy mode, child containers are returned as a LazyObject, and only decoded when accessed.
+	# The file_info subtree is always decoded.
+	# If seek_end is False the unpacker is left at an undefined offset, which saves skipping the last LazyObject.
+	#
+	def	unpack_object(self, unpacker, name = '', flags = 0, seek_end = True):
+		if unpacker.peek_u8() not in (32, 33):
+			return self.unpack_value(unpacker, name)
+
+		debug = global_vars.verbose >= global_vars.debug_level
+
+		start = unpacker.tell()
+		top = self.unpack_container(unpacker, name, flags)
+		stack = [top]
+		while stack:
+			frame = stack[-1]
+			obj, names, offsets, seek_base, i, path, flags = frame
+			if i == len(offsets):
+				# We have unpacked all our children
+				stack.pop()
+				if flags & ENTRY_FILE_INFO:
+					self.collect_fileinfo(obj)
+				continue
+			frame[4] = i + 1
+
+			# Build the path of the child for debugging
+			child_path = None
+			if debug:
+				if obj.t == 33:
+					child_path = "%s|%s" % (path, self.names[names[i]])
+				else:
+					child_path = "%s|%d" % (path, i)
+				print(">>> %s @0x%X entry %d:" % (child_path, seek_base + offsets[i], i))
+
+			# The root's file_info list (and everything in it) is always decoded
+			child_flags = 0
+			if flags & (ENTRY_FILE_INFO | ENTRY_IN_FILE_INFO):
+				child_flags = ENTRY_IN_FILE_INFO
+			elif flags & ENTRY_ROOT and obj.t == 33 and names[i] == self.file_info_ni:
+				child_flags = ENTRY_FILE_INFO
+
+			# Unpack the object at the offset
+			unpacker.seek(seek_base + offsets[i])
+			if unpacker.peek_u8() in (32, 33):
+				if self.lazy and not child_flags:
+					child = LazyObject(self, unpacker.tell(), child_path)
+				else:
+					child_frame = self.unpack_container(unpacker, child_path, child_flags)
+					child = child_frame[0]
+					stack.append(child_frame)
+			else:
+				child = self.unpack_value(unpacker, child_path)
 
-				# Remember our object data
-				temp_data.append(bytes(temp_packer._buffer))
+			# Add the object to our list
+			if obj.t == 33:
+				obj.v.append(NameObject(names[i], child))
+			else:
+				obj.v.append(child)
 
-			# Pack the list of names
-			self.pack_object(packer, '', TypeValue(13, temp_names))
+		# Leave the unpacker at the end of the object.
+		# We may not have decoded all of it, and the last child we unpacked is not the end if the offsets are not in order.
+		# Skipping is O(depth), so LazyObject doesn't ask for it (seek_end = False).
+		if seek_end:
+			unpacker.seek(start)
+			self.skip_object(unpacker)
 
-			# Pack the list of offsets
-			self.pack_object(packer, '', TypeValue(13, temp_offsets))
+		return top[0]
 
-			# Pack the object data
-			for od in temp_data:
-				l = len(od)
-				packer('<%ds' % l, od)
+	#
+	# Read the header of a container, and return the stack frame for unpack_object:
+	# [object, name indexes, offsets, offset of the first child, next child, path, flags]
+	#
+	def	unpack_container(self, unpacker, path, flags):
+		offset = unpacker.tell()
+		t = unpacker.read_u8()
+		if t == 33:
+			# array of name-objects
+			# from exm2lib, array of int name indexes, array of int offsets, followed by objects
+			names	= unpacker.read_int_array()
+			offsets	= unpacker.read_int_array()
+			assert(len(names) == len(offsets))
 		else:
-			print("Unknown type")
-			print(t)
-			assert(False)
+			# array of objects
+			# from exm2lib, array of offsets of objects, followed by the objects
+			names	= None
+			offsets	= unpacker.read_int_array()
+		if global_vars.verbose >= global_vars.debug_level:
+			print(">>> %s @0x%X (%d entries)" % (path, offset, len(offsets)))
+		return [TypeValue(t, []), names, offsets, unpacker.tell(), 0, path, flags]
 
-	def	unpack_object(self, unpacker, name):
+	#
+	# Build our FileInfo stash from the decoded file_info list.
+	# Each object is a type 32 collection containing the offset & length values of the file data in alldata.bin
+	# We build a list of FileInfo objects in the PSB for easy access, then mostly ignore the list in the tree.
+	#
+	def	collect_fileinfo(self, obj):
+		fileinfo = []
+		for no in obj.v:
+			v1 = no.o
+
+			# Sanity check our object
+			assert(v1.t == 32)
+			assert(len(v1.v) == 2)
+			assert(v1.v[0].t >= 4)
+			assert(v1.v[0].t <= 12)
+			assert(v1.v[1].t >= 4)
+			assert(v1.v[1].t <= 12)
+
+			# Get the offset and length
+			fo = v1.v[0].v
+			fl = v1.v[1].v
+
+			fileinfo.append(FileInfo(no.ni, fl, fo))
+
+		# If scan_fileinfo has already filled in our stash, keep it (it may have been updated since)
+		if not self.fileinfo:
+			self.fileinfo = fileinfo
+			self.build_fileinfo_index()
+
+	#
+	# Unpack a single value (anything but a type 32/33 container)
+	#
+	def	unpack_value(self, unpacker, name):
 		offset = unpacker.tell()
 		if global_vars.verbose >= global_vars.debug_level:
 			print("")
 			print(">>> %s @0x%X" % (name, unpacker.tell()))
 			print(unpacker.peek16())
-		t = unpacker.peek('<B')[0]
+		t = unpacker.peek_u8()
 		if t >= 1 and t <= 3:
 			# from exm2lib & inspection, length = 0, purpose unknown
-			t = unpacker('<B')[0]
+			t = unpacker.read_u8()
 			v = 0
 			if global_vars.verbose >= global_vars.debug_level:
 				print(">>> %s @0x%X type %d value ?" % (name, offset, t))
 			return TypeValue(t, None)
 		elif t == 4:
 			# int, 0 bytes
-			t = unpacker('<B')[0]
+			t = unpacker.read_u8()
 			v = 0
 			if global_vars.verbose >= global_vars.debug_level:
 				print(">>> %s @0x%X type %d value %d 0x%X" % (name, offset, t, v, v))
 			return TypeValue(t, 0)
 		elif t >= 5 and t <= 12:
 			# int, 1-8 bytes
-			t = unpacker('<B')[0]
-			v = int.from_bytes(unpacker('<%dB' % (t - 5 + 1)), 'little')
+			t = unpacker.read_u8()
+			v = unpacker.read_uint(t - 5 + 1)
 			if global_vars.verbose >= global_vars.debug_level:
 				print(">>> %s @0x%X type %d value %d 0x%X" % (name, offset, t, v, v))
 			return TypeValue(t, v)
 		elif t >= 13 and t <= 20:
 			# array of ints, packed as size of count, count, size of entries, entries[]
-			t = unpacker('<B')[0]
-			size_count = t - 12
-			count = int.from_bytes(unpacker('<%dB' % size_count), 'little')
-			size_entries = unpacker('<B')[0] - 12
-			values = []
-			for i in range(0, count):
-				v = int.from_bytes(unpacker('<%dB' % size_entries), 'little')
-				values.append(v)
+			values = unpacker.read_int_array()
 			return TypeValue(t, values)
 		elif t >= 21 and t <= 24:
 			# index into strings array, 1-4 bytes
-			t = unpacker('<B')[0]
-			v = int.from_bytes(unpacker('<%dB' % (t - 21 + 1)), 'little')
+			t = unpacker.read_u8()
+			v = unpacker.read_uint(t - 21 + 1)
 			if global_vars.verbose >= global_vars.debug_level:
 				print(">>> %s @0x%X type %d value string %d" % (name, offset, t, v))
 			assert(v <= len(self.strings))
-			return String(t, v, self.strings[v])
+			return String(t, v)
 		elif t >= 25 and t <= 28:
 			# index into chunks array, 1-4 bytes
-			t = unpacker('<B')[0]
-			v = int.from_bytes(unpacker('<%dB' % (t - 25 + 1)), 'little')
+			t = unpacker.read_u8()
+			v = unpacker.read_uint(t - 25 + 1)
 			if global_vars.verbose >= global_vars.debug_level:
 				print(">>> %s @0x%X type %d value chunk %d" % (name, offset, t, v))
 			assert(v <= len(self.chunkdata))
 			return TypeValue(t, v)
 		elif t == 29:
 			# float, 0 bytes?
-			t = unpacker('<B')[0]
+			t = unpacker.read_u8()
 			if global_vars.verbose >= global_vars.debug_level:
 				print(">>> %s @0x%X type %d value ?" % (name, offset, t))
 			return TypeValue(t, 0.0)
 		elif t == 30:
 			# float, 4 bytes
-			t = unpacker('<B')[0]
-			v = unpacker('f')[0]
+			t = unpacker.read_u8()
+			v = unpacker.read_f32()
 			if global_vars.verbose >= global_vars.debug_level:
 				print(">>> %s @0x%X type %d value %f" % (name, offset, t, v))
 			return TypeValue(t, v)
 		elif t == 31:
 			# float, 8 bytes
-			t = unpacker('<B')[0]
-			v = unpacker('d')[0]
+			t = unpacker.read_u8()
+			v = unpacker.read_f64()
 			if global_vars.verbose >= global_vars.debug_level:
 				print(">>> %s @0x%X type %d value %f" % (name, offset, t, v))
 			return TypeValue(t, v)
-		elif t == 32:
-			# array of objects
-			# from exm2lib, array of offsets of objects, followed by the objects
-			t = unpacker('<B')[0]
-			offsets = self.unpack_object(unpacker, name + '|offsets')
-			seek_base = unpacker.tell()
-			if global_vars.verbose >= global_vars.debug_level:
-				print(">>> %s @0x%X (%d entries)" % (name, offset, len(offsets.v)))
-			v = []
-			for i in range(0, len(offsets.v)):
-				o = offsets.v[i]
-				if global_vars.verbose >= global_vars.debug_level:
-					print(">>> %s @0x%X entry %d:" % (name, offset, i))
-				unpacker.seek(seek_base + o)
-				v1 = self.unpack_object(unpacker, name + "|%d" % i)
-				v.append(v1)
-			return TypeValue(t, v)
-		elif t == 33:
-			# array of name-objects
-			# from exm2lib, array of int name indexes, array of int offsets, followed by objects
-			t = unpacker('<B')[0]
-			names   = self.unpack_object(unpacker, name + '|names')
-			offsets = self.unpack_object(unpacker, name + '|offsets')
-			seek_base = unpacker.tell()
-			assert(len(names.v) == len(offsets.v))
-			if global_vars.verbose >= global_vars.debug_level:
-				print(">>> %s @0x%X (%d entries)" % (name, offset, len(names.v)))
-
-			# For each entry in the name list...
-			v = []
-			for i, ni in enumerate(names.v):
-				# Get the name string and the offset
-				ns = self.names[ni]
-				o = offsets.v[i]
-				if global_vars.verbose >= global_vars.debug_level:
-					print(">>> %s|%s @0x%X entry %d:" % (name, ns, offset, i))
-					print(unpacker.peek16())
-
-				# Unpack the object at the offset
-				unpacker.seek(seek_base + o)
-				v1 = self.unpack_object(unpacker, name + "|%s" % ns)
-
-				# Add the object to our list
-				v.append(NameObject(ni, v1, self.names[ni]))
-
-				# If we are a file_info list, each object is a type 32 collection containing the offset & length values of the file data in alldata.bin
-				# We build a list of FileInfo objects in the PSB for easy access, then mostly ignore the list in the tree.
-				if name == '|file_info':
-
-					# Sanity check our object
-					assert(v1.t == 32)
-					assert(len(v1.v) == 2)
-					assert(v1.v[0].t >= 4)
-					assert(v1.v[0].t <= 12)
-					assert(v1.v[1].t >= 4)
-					assert(v1.v[1].t <= 12)
-
-					# Get the offset and length
-					fo = v1.v[0].v
-					fl = v1.v[1].v
-
-					# Save the FileInfo in our stash
-					self.fileinfo.append(FileInfo(ni, fl, fo))
-
-			return TypeValue(t, v)
-
 		else:
 			print(">>> %s @0x%X" % (name, offset))
 			print("Unknown type")
@@ -871,24 +1691,24 @@ class	PSB():
 		# Pack our offsets array
 		self.header.offset_chunk_offsets	= packer.tell()
 		if self.raw_chunk_offsets:
-			packer('<%ds' % len(self.raw_chunk_offsets), bytes(self.raw_chunk_offsets))
+			packer.write_bytes(self.raw_chunk_offsets)
 		else:
 			self.pack_object(packer, 'chunk_offsets', TypeValue(13, offsets))
 
 		# Pack our lengths array
 		self.header.offset_chunk_lengths	= packer.tell()
 		if self.raw_chunk_lengths:
-			packer('<%ds' % len(self.raw_chunk_lengths), bytes(self.raw_chunk_lengths))
+			packer.write_bytes(self.raw_chunk_lengths)
 		else:
 			self.pack_object(packer, 'chunk_lengths', TypeValue(13, lengths))
 
 		# Pack our data
 		self.header.offset_chunk_data		= packer.tell()
 		if self.raw_chunk_data:
-			packer('<%ds' % len(self.raw_chunk_data), bytes(self.raw_chunk_data))
+			packer.write_bytes(self.raw_chunk_data)
 		else:
 			for i in range(0, len(self.chunkdata)):
-				packer('<%ds' % len(self.chunkdata[i]), self.chunkdata[i])
+				packer.write_bytes(self.chunkdata[i])
 		
 	def	unpack_chunks(self, unpacker):
 		self.chunkdata		= []
@@ -900,7 +1720,7 @@ class	PSB():
 			print("Chunk offsets count %d" % len(chunk_offsets.v))
 			for i in range(0, len(chunk_offsets.v)):
 				print("Chunk offset %d = %d 0x%X" % (i, chunk_offsets.v[i], chunk_offsets.v[i]))
-		self.raw_chunk_offsets = unpacker._buffer[self.header.offset_chunk_offsets : unpacker.tell()]
+		self.raw_chunk_offsets = unpacker.get_bytes(self.header.offset_chunk_offsets, unpacker.tell())
 
 
 		# Read in our chunk lengths array (this may be empty)
@@ -910,7 +1730,7 @@ class	PSB():
 			print("Chunk lengths count %d" % len(chunk_lengths.v))
 			for i in range(0, len(chunk_lengths.v)):
 				print("Chunk length %d = %d 0x%X" % (i, chunk_lengths.v[i], chunk_lengths.v[i]))
-		self.raw_chunk_lengths = unpacker._buffer[self.header.offset_chunk_lengths : unpacker.tell()]
+		self.raw_chunk_lengths = unpacker.get_bytes(self.header.offset_chunk_lengths, unpacker.tell())
 
 		assert(len(chunk_offsets.v) == len(chunk_lengths.v))
 
@@ -923,30 +1743,187 @@ class	PSB():
 
 				# Save the chunk data
 				unpacker.seek(self.header.offset_chunk_data + o)
-				d = unpacker.data()[:l]
+				d = unpacker.data()[:l].tobytes()
 				self.chunkdata.append(d)
 
 				# Save the chunk filename
 				self.chunknames.append(self.getChunkFilename(i))
-		self.raw_chunk_data = unpacker._buffer[self.header.offset_chunk_data : unpacker.tell()]
+		self.raw_chunk_data = unpacker.get_bytes(self.header.offset_chunk_data, unpacker.tell())
 
 	def	pack_entries(self, packer):
+		# If the entries tree has been decoded it may have been modified, so the cached entries block is stale.
+		# Only the decoded containers are re-encoded, the rest are copied from the PSB data (see LazyObject)
+		if isinstance(self.entries, LazyObject) and self.entries.is_decoded():
+			self.raw_entries = None
+
+		# Patch our new offsets/lengths into the cached entries block, or re-encode the tree if we can't
+		if self.raw_entries and self.fileinfo_changed:
+			if not self.patch_fileinfo():
+				self.raw_entries = None
+
 		if self.raw_entries:
 			self.header.offset_entries		= packer.tell()
-			packer('<%ds' % len(self.raw_entries), bytes(self.raw_entries))
+			packer.write_bytes(self.raw_entries)
 		else:
+			# Decode the root, so the file_info list is re-populated from our FileInfo
+			if isinstance(self.entries, LazyObject):
+				self.entries.decode()
 			self.header.offset_entries = packer.tell()
-			self.pack_object(packer, '', self.entries)
+			self.pack_object(packer, '', self.entries, flags = ENTRY_ROOT)
 
 	def	unpack_entries(self, unpacker):
+		if self.lazy:
+			# Find the file_info without decoding the tree, and decode the tree on demand
+			self.scan_fileinfo(unpacker)
+			self.entries = LazyObject(self, self.header.offset_entries, '', ENTRY_ROOT)
+			unpacker.seek(self.header.offset_entries)
+			self.skip_object(unpacker)
+		else:
+			unpacker.seek(self.header.offset_entries)
+			self.entries = self.unpack_object(unpacker, '', ENTRY_ROOT)
+		self.raw_entries = unpacker.get_bytes(self.header.offset_entries, unpacker.tell())
+
+		# Find the FileInfo fields in the raw entries, so we can patch them
+		if not self.lazy:
+			self.fileinfo_fields = self.locate_fileinfo(self.raw_entries)[1]
+
+	#
+	# Fill in self.fileinfo from the root's file_info list, without decoding the entries tree.
+	#
+	def	scan_fileinfo(self, unpacker):
 		unpacker.seek(self.header.offset_entries)
-		self.entries = self.unpack_object(unpacker, '')
-		self.raw_entries = unpacker._buffer[self.header.offset_entries : unpacker.tell()]
+		self.fileinfo, self.fileinfo_fields = self.locate_fileinfo(unpacker.data())
+		self.build_fileinfo_index()
+
+		if global_vars.verbose >= global_vars.trace_level:
+			print("Found %d file_info entries" % len(self.fileinfo))
+		return self.fileinfo
+
+	#
+	# Find the root's file_info list in the packed entries.
+	# This jumps straight to the file_info entry of the root type 33 container using the names index.
+	#
+	# Returns the list of FileInfo, and for each FileInfo the (position, size) of its offset & length ints,
+	# relative to the start of the entries.
+	#
+	def	locate_fileinfo(self, entries_data):
+		fileinfo	= []
+		fields		= []
+		if self.file_info_ni is None:
+			return fileinfo, fields
+
+		# Find the file_info entry in the root
+		unpacker = buffer_unpacker(entries_data)
+		if unpacker.read_u8() != 33:
+			return fileinfo, fields
+		names	= unpacker.read_int_array()
+		offsets	= unpacker.read_int_array()
+		if self.file_info_ni not in names:
+			return fileinfo, fields
+		unpacker.seek(unpacker.tell() + offsets[names.index(self.file_info_ni)])
+
+		# The file_info is a type 33 list of type 32 [offset, length]
+		assert(unpacker.read_u8() == 33)
+		names	= unpacker.read_int_array()
+		offsets	= unpacker.read_int_array()
+		seek_base = unpacker.tell()
+		assert(len(names) == len(offsets))
+		for ni, o in zip(names, offsets):
+			unpacker.seek(seek_base + o)
+			assert(unpacker.read_u8() == 32)
+			fo_offsets = unpacker.read_int_array()
+			assert(len(fo_offsets) == 2)
+			fo_base = unpacker.tell()
+
+			# Get the offset and length, and where they are
+			unpacker.seek(fo_base + fo_offsets[0])
+			assert(unpacker.peek_u8() >= 4 and unpacker.peek_u8() <= 12)
+			fo_field = (unpacker.tell(), unpacker.peek_u8() - 4)
+			fo = unpacker.read_int()
+			unpacker.seek(fo_base + fo_offsets[1])
+			assert(unpacker.peek_u8() >= 4 and unpacker.peek_u8() <= 12)
+			fl_field = (unpacker.tell(), unpacker.peek_u8() - 4)
+			fl = unpacker.read_int()
+
+			fileinfo.append(FileInfo(ni, fl, fo))
+			fields.append((fo_field, fl_field))
+
+		return fileinfo, fields
+
+	#
+	# Write our FileInfo offsets/lengths into raw_entries, instead of re-encoding the entries tree.
+	#
+	# Each value is written over the int it replaces, if it fits.
+	# Otherwise we re-encode the file_info list, and fix the offsets of the root's children which follow it.
+	# Returns False if we can't patch the entries (and the tree needs re-encoding).
+	#
+	def	patch_fileinfo(self):
+		# Make sure our offset/lengths are current
+		if self.subfile_data is not None:
+			self.update_fileinfo()
+
+		if not self.fileinfo_fields or len(self.fileinfo_fields) != len(self.fileinfo):
+			return False
+
+		raw_entries = bytearray(self.raw_entries)
+		resize = False
+		for fi, fields in zip(self.fileinfo, self.fileinfo_fields):
+			for v, (pos, size) in zip((fi.o, fi.l), fields):
+				# Keep the most significant bit clear, as for type 100
+				if v and getUnsignedIntSize(v) > size:
+					resize = True
+					break
+				raw_entries[pos + 1 : pos + 1 + size] = v.to_bytes(size, 'little')
+			if resize:
+				break
+
+		if resize:
+			if global_vars.verbose >= global_vars.trace_level:
+				print("Re-encoding file_info list")
+			raw_entries = self.repack_fileinfo(raw_entries)
+
+		self.raw_entries	= bytes(raw_entries)
+		self.fileinfo_fields	= self.locate_fileinfo(self.raw_entries)[1]
+		self.fileinfo_changed	= False
+		return True
+
+	#
+	# Re-encode the root's file_info list in the packed entries.
+	# The root's offsets table is rewritten to move the children which follow the file_info list.
+	#
+	def	repack_fileinfo(self, entries_data):
+		unpacker = buffer_unpacker(entries_data)
+		assert(unpacker.read_u8() == 33)
+		names	= unpacker.read_int_array()
+		offsets	= unpacker.read_int_array()
+		seek_base = unpacker.tell()
+
+		# Find the old file_info list
+		fi_offset = offsets[names.index(self.file_info_ni)]
+		unpacker.seek(seek_base + fi_offset)
+		start = unpacker.tell()
+		self.skip_object(unpacker)
+		end = unpacker.tell()
+
+		# Pack the new file_info list (this is populated from self.fileinfo)
+		fi_packer = buffer_packer()
+		self.pack_object(fi_packer, '|file_info', TypeValue(33, []), flags = ENTRY_FILE_INFO)
+		delta = fi_packer.length() - (end - start)
+
+		# Rewrite the root with the new offsets
+		packer = buffer_packer()
+		packer.write_u8(33)
+		self.pack_object(packer, '', TypeValue(13, names))
+		self.pack_object(packer, '', TypeValue(13, [o + delta if o > fi_offset else o for o in offsets]))
+		packer.write_bytes(entries_data[seek_base : start])
+		packer.write_bytes(fi_packer.getbuffer())
+		packer.write_bytes(entries_data[end : ])
+		return packer.getvalue()
 
 	def	pack_names(self, packer):
 		if self.raw_names:
 			self.header.offset_names		= packer.tell()
-			packer('<%ds' % len(self.raw_names), bytes(self.raw_names))
+			packer.write_bytes(self.raw_names)
 		else:
 			# Encode the self.names array back into 3 arrays
 			nt = PSB_NameTable()
@@ -957,6 +1934,10 @@ class	PSB():
 			self.pack_object(packer, 'jumps',   TypeValue(13, nt.jumps))
 			self.pack_object(packer, 'starts',  TypeValue(13, nt.starts))
 
+			# The names may have been replaced, find the file_info for pack_entries
+			if 'file_info' in self.names:
+				self.file_info_ni = self.names.index('file_info')
+
 	def	unpack_names(self, unpacker):
 
 		unpacker.seek(self.header.offset_names)
@@ -968,13 +1949,16 @@ class	PSB():
 
 		# Decode the 3 arrays into simple strings
 		self.names		= []
-		for i in range(0, len(nt.starts)):
-			s = nt.get_name(i).rstrip('\0')
+		for i, s in enumerate(nt.decode_all()):
+			s = s.rstrip('\0')
 			self.names.append(s)
 			if global_vars.verbose >= global_vars.trace_level:
 				print("Name %d %s" % (i, s))
 
-		self.raw_names = unpacker._buffer[self.header.offset_names : unpacker.tell()]
+		self.raw_names = unpacker.get_bytes(self.header.offset_names, unpacker.tell())
+
+		if 'file_info' in self.names:
+			self.file_info_ni = self.names.index('file_info')
 
 		if global_vars.verbose >= global_vars.debug_level:
 			nt2 = PSB_NameTable()
@@ -995,51 +1979,90 @@ class	PSB():
 	# Pack our strings[] array, and update our header with the offsets
 	#
 	def	pack_strings(self, packer):
-		# Build the list of offsets
+		# Encode each string once, and build the list of offsets
+		encoded = []
 		offsets = []
-		offset = 0
-		for s in self.strings:
-			se = s.encode('utf-8')
-			l = len(se) +1	# +1 for the NUL byte
-			offsets.append(offset)
-			offset += l
+		if not self.raw_strings_offsets or not self.raw_strings_data:
+			offset = 0
+			for s in self.strings:
+				se = s.encode('utf-8')
+				encoded.append(se)
+				offsets.append(offset)
+				offset += len(se) + 1	# +1 for the NUL byte
 
 		# Pack our offsets array object
 		self.header.offset_strings		= packer.tell()
 		if self.raw_strings_offsets:
-			packer('<%ds' % len(self.raw_strings_offsets), bytes(self.raw_strings_offsets))
+			packer.write_bytes(self.raw_strings_offsets)
 		else:
 			self.pack_object(packer, 'strings', TypeValue(13, offsets))
 
 		# Pack our data
 		self.header.offset_strings_data	= packer.tell()
 		if self.raw_strings_data:
-			packer('<%ds' % len(self.raw_strings_data), bytes(self.raw_strings_data))
-		else:
-			for s in self.strings:
-				se = s.encode('utf-8')
-				l = len(se) +1	# +1 for the NUL byte
-				packer('<%ds' % l, se)
+			packer.write_bytes(self.raw_strings_data)
+		elif encoded:
+			packer.write_bytes(b'\0'.join(encoded) + b'\0')	# +1 for the NUL byte
 
 	def	unpack_strings(self, unpacker):
 		self.strings	= []
 
 		unpacker.seek(self.header.offset_strings)
 		strings_array	= self.unpack_object(unpacker, 'strings')
-		self.raw_strings_offsets = unpacker._buffer[self.header.offset_strings : unpacker.tell()]
+		self.raw_strings_offsets = unpacker.get_bytes(self.header.offset_strings, unpacker.tell())
 
 		if global_vars.verbose >= global_vars.trace_level:
 			print("Parsing strings array (%d)" % len(strings_array.v))
+
+		# Take a copy of the strings data, up to the start of the next section
+		start	= self.header.offset_strings_data
+		end	= min([o for o in self.header.get_offsets() if o > start] + [unpacker.length()])
+		data	= unpacker.get_bytes(start, end)
+		if strings_array.v and not data.endswith(b'\0'):
+			# The last string runs past the next section, take everything
+			data = unpacker.get_bytes(start, unpacker.length())
+
+		# Split the data into NUL-terminated C-strings, and map the offset of each one to its data
+		strings_data = {}
+		o = 0
+		for sd in data.split(b'\0'):
+			strings_data[o] = sd
+			o += len(sd) + 1
+
 		# Read in each string
-		for i in range(0, len(strings_array.v)):
-			o = strings_array.v[i]
-			# Create a python string from the NUL-terminated C-string at offset
-			unpacker.seek(self.header.offset_strings_data + o)
-			s = unpacker.get_cstr();
+		end = unpacker.tell()
+		for i, o in enumerate(strings_array.v):
+			sd = strings_data.get(o)
+			if sd is None:
+				# This string is the tail of another string
+				sd = data[o : data.find(b'\0', o)]
+			s = str(sd, 'utf-8')
 			self.strings.append(s)
 			if global_vars.verbose >= global_vars.debug_level:
 				print("String %d  @0x%X %s" % (i, o, s))
-		self.raw_strings_data = unpacker._buffer[self.header.offset_strings_data : unpacker.tell()]
+			end = start + o + len(sd) + 1
+		self.raw_strings_data = unpacker.get_bytes(start, end)
+
+		self.build_string_index()
+
+	# Build the dict of string -> index into our strings
+	def	build_string_index(self):
+		self.string_index = {}
+		for i, s in enumerate(self.strings):
+			self.string_index.setdefault(s, i)
+
+	# Get the index of the string in our strings, adding it if needed
+	def	add_string(self, s):
+		i = self.string_index.get(s)
+		if i is None:
+			i = len(self.strings)
+			self.strings.append(s)
+			self.string_index[s] = i
+
+			# Our cached strings sections are stale
+			self.raw_strings_offsets	= None
+			self.raw_strings_data		= None
+		return i
 
 class	PSB_HDR():
 	def	__init__(self):
@@ -1071,38 +2094,63 @@ class	PSB_HDR():
 
 
 	def	pack(self, packer):
- 		packer('>4s',	bytes(self.signature))
- 		packer('<I',	self.type)
- 		packer('<I',	self.unknown1)
- 		packer('<I',	self.offset_names)
- 		packer('<I',	self.offset_strings)
- 		packer('<I',	self.offset_strings_data)
- 		packer('<I',	self.offset_chunk_offsets)
- 		packer('<I',	self.offset_chunk_lengths)
- 		packer('<I',	self.offset_chunk_data)
- 		packer('<I',	self.offset_entries)
+		packer.write_bytes(bytes(self.signature))
+		packer.write_u32(self.type)
+		packer.write_u32(self.unknown1)
+		packer.write_u32(self.offset_names)
+		packer.write_u32(self.offset_strings)
+		packer.write_u32(self.offset_strings_data)
+		packer.write_u32(self.offset_chunk_offsets)
+		packer.write_u32(self.offset_chunk_lengths)
+		packer.write_u32(self.offset_chunk_data)
+		packer.write_u32(self.offset_entries)
+
+	# Get the offsets of each section
+	def	get_offsets(self):
+		return [
+			self.offset_names,
+			self.offset_strings,
+			self.offset_strings_data,
+			self.offset_chunk_offsets,
+			self.offset_chunk_lengths,
+			self.offset_chunk_data,
+			self.offset_entries,
+		]
 
 	def	unpack(self, unpacker):
-		self.signature			= unpacker('>4s')[0]
-		self.type			= unpacker('<I')[0]
-		self.unknown1			= unpacker('<I')[0]
-		self.offset_names		= unpacker('<I')[0]
-		self.offset_strings		= unpacker('<I')[0]
-		self.offset_strings_data	= unpacker('<I')[0]
-		self.offset_chunk_offsets	= unpacker('<I')[0]
-		self.offset_chunk_lengths	= unpacker('<I')[0]
-		self.offset_chunk_data		= unpacker('<I')[0]
-		self.offset_entries		= unpacker('<I')[0]
+		self.signature			= bytes(unpacker.read_bytes(4))
+		self.type			= unpacker.read_u32()
+		self.unknown1			= unpacker.read_u32()
+		self.offset_names		= unpacker.read_u32()
+		self.offset_strings		= unpacker.read_u32()
+		self.offset_strings_data	= unpacker.read_u32()
+		self.offset_chunk_offsets	= unpacker.read_u32()
+		self.offset_chunk_lengths	= unpacker.read_u32()
+		self.offset_chunk_data		= unpacker.read_u32()
+		self.offset_entries		= unpacker.read_u32()
 
 #
-# Get the XOR key for the given filename
+# Get the list of FileInfo from the PSB data, without decoding the strings, chunks or entries tree.
+# The FileInfo.ni are indexes into the PSB's names.
 #
-def	get_xor_key(filename):
+def	scan_fileinfo(psb_data):
+	mypsb = PSB()
+	unpacker = buffer_unpacker(psb_data)
+	mypsb.header.unpack(unpacker)
+	if mypsb.header.signature != b'PSB\x00':
+		return []
+	mypsb.unpack_names(unpacker)
+	return mypsb.scan_fileinfo(unpacker)
+
+#
+# Derive the XOR key for the given (lowercased) basename
+#
+def	derive_xor_key(basename):
 	fixed_seed	= b'MX8wgGEJ2+M47'	# From m2engage.elf
 	key_length	= 0x50
 
 	# Take our game hash_seed (always the same), and append our filename
-	hash_seed = fixed_seed + os.path.basename(filename).lower().encode('latin-1')
+	hash_seed = fixed_seed + basename.encode('latin-1')
 	if global_vars.verbose >= global_vars.trace_level:
 		print("Using hash seed:\t%s" % hash_seed)
 
@@ -1111,35 +2159,143 @@ def	get_xor_key(filename):
 	hash_as_longs = struct.unpack('<4I', hash_as_bytes)
 
 	# Initialize our mersenne twister
-	mt19937.init_by_array(hash_as_longs)
-
-	# Start with an empty key buffer
-	key_buffer = bytearray()
+	mt = mt19937.MT19937()
+	mt.init_by_array(hash_as_longs)
 
-	# Initialize our key from the MT
-	while len(key_buffer) < key_length:
-		# Get the next 32 bits from our MT-PRNG, as a long
-		l = mt19937.genrand_int32();
-		# Convert to 4 bytes little-endian
-		s = struct.pack('<L', l)
-
-		# Add them to our key buffer
-		key_buffer.extend(s)
+	# Initialize our key from the MT, as 32 bit little-endian words
+	key_buffer = mt.genrand_block(key_length // 4, as_bytes=True)
 	if global_vars.verbose >= global_vars.trace_level:
-		print("Using key:\t%s," % binascii.hexlify(bytes(key_buffer)))
+		print("Using key:\t%s," % binascii.hexlify(key_buffer))
 
 	return key_buffer
-	
+
+#
+# LRU cache of derived XOR keys, keyed by the lowercased basename.
+#
+# If a store file is opened, the keys in the file are loaded and each newly derived key
+# is appended to it, so the next process can skip the derivation.
+# The stored keys are kept apart from the LRU and are never evicted,
+# so each basename is only written to the store once.
+#
+class	XorKeyCache():
+	def	__init__(self, maxsize = 1024):
+		self.maxsize		= maxsize
+		self.hits		= 0
+		self.misses		= 0
+		self.store_filename	= None
+		self._keys		= collections.OrderedDict()
+		self._stored_keys	= {}	# dict of basename -> key for every key in the store file
+		self._lock		= threading.Lock()
+
+	def	__len__(self):
+		return len(self._keys)
+
+	def	__str__(self):
+		return "XOR key cache: %d entries, %d stored, %d hits, %d misses" % (len(self._keys), len(self._stored_keys), self.hits, self.misses)
+
+	def	clear(self):
+		with self._lock:
+			self._keys.clear()
+			self.hits	= 0
+			self.misses	= 0
+
+	def	_insert(self, basename, key_buffer):
+		self._keys[basename] = key_buffer
+		self._keys.move_to_end(basename)
+		while len(self._keys) > self.maxsize:
+			self._keys.popitem(last = False)
+
+	def	get(self, filename):
+		basename = os.path.basename(filename).lower()
+
+		with self._lock:
+			key_buffer = self._keys.get(basename)
+			if key_buffer is not None:
+				self._keys.move_to_end(basename)
+				self.hits += 1
+				return key_buffer
+
+			# Evicted (or not used yet), but in the store
+			key_buffer = self._stored_keys.get(basename)
+			if key_buffer is not None:
+				self._insert(basename, key_buffer)
+				self.hits += 1
+				return key_buffer
+			self.misses += 1
+
+		key_buffer = derive_xor_key(basename)
+
+		with self._lock:
+			self._insert(basename, key_buffer)
+			# Another thread may have derived and stored the same key meanwhile
+			if self.store_filename and basename not in self._stored_keys:
+				self._stored_keys[basename] = key_buffer
+				with open(self.store_filename, 'at', encoding='utf-8') as f:
+					f.write("%s %s\n" % (binascii.hexlify(key_buffer).decode('ascii'), basename))
+
+		return key_buffer
+
+	# Load the keys from the store file (if it exists), and append new keys to it
+	# If a basename is in the file more than once, the first key is used.
+	def	open_store(self, filename):
+		with self._lock:
+			self._stored_keys = {}
+		if os.path.isfile(filename):
+			with open(filename, 'rt', encoding='utf-8') as f:
+				for line in f:
+					# Each line is "<hex key> <basename>"
+					hex_key, _, basename = line.rstrip('\n').partition(' ')
+					try:
+						key_buffer = binascii.unhexlify(hex_key)
+					except binascii.Error:
+						continue
+					if basename and len(key_buffer) == 0x50 and basename not in self._stored_keys:
+						with self._lock:
+							self._stored_keys[basename] = key_buffer
+			if global_vars.verbose >= global_vars.trace_level:
+				print("Loaded %d keys from '%s'" % (len(self._stored_keys), filename))
+		self.store_filename = filename
+
+xor_key_cache = XorKeyCache()
+
+#
+# Get the XOR key for the given filename
+#
+def	get_xor_key(filename):
+	return bytearray(xor_key_cache.get(filename))
+
+#
+# XOR the data with the key repeated out to the length of the data.
+# phase is the position in the key of the first byte of data.
+# This returns a new bytearray and leaves the original untouched.
+#
+def	xor_data(data, key_buffer, phase = 0):
+	length = len(data)
+	if length == 0:
+		return bytearray()
+
+	# Tile the key out to the length of the data, starting at our phase
+	key_len = len(key_buffer)
+	phase %= key_len
+	repeats = (phase + length + key_len - 1) // key_len
+	keystream = (bytes(key_buffer) * repeats)[phase : phase + length]
+
+	# XOR the whole buffer at once
+	if numpy is not None:
+		out = numpy.frombuffer(data, dtype=numpy.uint8) ^ numpy.frombuffer(keystream, dtype=numpy.uint8)
+		return bytearray(out.tobytes())
+
+	# Without numpy, python's big ints do the XOR in C
+	out = int.from_bytes(data, 'little') ^ int.from_bytes(keystream, 'little')
+	return bytearray(out.to_bytes(length, 'little'))
 
 #
 # Unobfuscate the data
 # This returns a copy of the unobfuscated data and leaves the original untouched.
 #
 def	unobfuscate_data(original_data, filename):
-	data = original_data[:]
-
 	header = HDRLEN()
-	header.unpack(buffer_unpacker(data))
+	header.unpack(buffer_unpacker(original_data))
 
 	if header.signature == b'mdf\x00':
 		if global_vars.verbose >= global_vars.debug_level:
@@ -1148,12 +2304,12 @@ def	unobfuscate_data(original_data, filename):
 
 		key_buffer = get_xor_key(filename)
 
-		# For each byte after the HDRLEN, XOR in our key
-		key_len = len(key_buffer)
-		for i in range(len(data) - header.offset1):
-			data[i + header.offset1] ^= key_buffer[i % key_len]
+		# Copy the HDRLEN as-is, and XOR in our key for every byte after it
+		data = bytearray(original_data[ : header.offset1])
+		data += xor_data(memoryview(original_data)[header.offset1 : ], key_buffer)
+		return data
 
-	return data
+	return original_data[:]
 
 #
 # Compress the data and prepend a mdf header
@@ -1170,13 +2326,115 @@ def	compress_data(data, level = 9):
 	# Compressed the data
 	try:
 		compressed = zlib.compress(data, level)
-		packer('<%ds'% len(compressed), compressed)
+		packer.write_bytes(compressed)
+	except Exception as e:
+		# We could not compress it, use the uncompressed data
+		print("Compression failed", e)
+		packer.write_bytes(data)
+
+	return bytearray(packer.getbuffer())
+
+# Size of the blocks used by compress_stream and uncompress_stream
+STREAM_CHUNK_SIZE	= 0x100000
+
+#
+# Copy count bytes from offset in the file object src to the current position of the file object dst.
+#
+# The data is copied by the kernel with os.copy_file_range (or os.sendfile) where possible,
+# so it does not pass through python. Otherwise we fall back to a buffered copy.
+#
+def	copy_file_data(src, offset, count, dst):
+	dst.flush()
+	position	= dst.tell()
+	copied		= 0
+
+	if hasattr(os, 'copy_file_range'):
+		try:
+			while copied < count:
+				length = os.copy_file_range(src.fileno(), dst.fileno(), count - copied, offset + copied, position + copied)
+				if length == 0:
+					break
+				copied += length
+		except OSError:
+			# Not supported for these files
+			pass
+
+	if copied < count and hasattr(os, 'sendfile'):
+		# sendfile writes at the file position of dst
+		os.lseek(dst.fileno(), position + copied, os.SEEK_SET)
+		try:
+			while copied < count:
+				length = os.sendfile(dst.fileno(), src.fileno(), offset + copied, count - copied)
+				if length == 0:
+					break
+				copied += length
+		except OSError:
+			# Not supported for these files
+			pass
+
+	# Copy anything left the slow way
+	dst.seek(position + copied)
+	src.seek(offset + copied)
+	while copied < count:
+		data = src.read(min(count - copied, STREAM_CHUNK_SIZE))
+		if not data:
+			break
+		dst.write(data)
+		copied += len(data)
+
+	assert(copied == count)
+	dst.seek(position + count)
+
+#
+# Compress the data, prepend a mdf header, and encrypt it using the filename as the key.
+#
+# This yields the header followed by each encrypted block of compressed data, so the
+# caller can write them straight to a file or append them to a buffer.
+# The data is compressed chunk_size bytes at a time, and only one block is held at once.
+# If debug_fd is given, the compressed (unencrypted) data is written to it.
+#
+def	compress_stream(data, filename, level = 9, chunk_size = STREAM_CHUNK_SIZE, debug_fd = None):
+	packer = buffer_packer()
+
+	# Create a header
+	header = HDRLEN()
+	header.signature = b'mdf\x00'
+	header.length = len(data)
+	header.pack(packer)
+
+	header_data = packer.getvalue()
+	if debug_fd:
+		debug_fd.write(header_data)
+	yield header_data
+
+	try:
+		compressor = zlib.compressobj(level)
 	except Exception as e:
 		# We could not compress it, use the uncompressed data
 		print("Compression failed", e)
-		packer('<%ds' % len(data), data)
+		compressor = None
+
+	key_buffer	= get_xor_key(filename)
+	phase		= 0
+	view		= memoryview(data)
+	for offset in range(0, len(view) + 1, chunk_size):
+		chunk = view[offset : offset + chunk_size]
+		if compressor:
+			block = compressor.compress(chunk)
+			# Flush the compressor after the last chunk
+			if offset + chunk_size > len(view):
+				block += compressor.flush()
+		else:
+			block = chunk
+		if not block:
+			continue
 
-	return bytearray(packer._buffer)
+		if debug_fd:
+			debug_fd.write(block)
+
+		# Encrypt the block, continuing the key from the end of the last block
+		yield xor_data(block, key_buffer, phase)
+		phase += len(block)
 
 #
 # Uncompress the data
@@ -1200,6 +2458,68 @@ def	uncompress_data(data):
 		# Return the data as-is
 		return data
 
+#
+# Read encrypted/compressed data from the file object fd, and yield the uncompressed data.
+#
+# The data is read chunk_size bytes at a time, each chunk is XORed with the key at the
+# right phase and fed to the decompressor, so we never hold the whole file in memory.
+# If debug_fd is given, the decrypted (still compressed) data is written to it.
+# Data without a mdf header is yielded as-is.
+#
+def	uncompress_stream(fd, filename, chunk_size = STREAM_CHUNK_SIZE, debug_fd = None):
+	header_data = bytes(fd.read(8))
+
+	header = HDRLEN()
+	if len(header_data) == 8:
+		header.unpack(buffer_unpacker(header_data))
+
+	if header.signature != b'mdf\x00':
+		# Return the data as-is
+		yield header_data
+		while True:
+			data = fd.read(chunk_size)
+			if not data:
+				return
+			yield data
+
+	if global_vars.verbose >= global_vars.debug_level:
+		print("sig=%s" % header.signature)
+		print("len=%d (0x%X)" % (header.length, header.length))
+
+	if debug_fd:
+		debug_fd.write(header_data)
+
+	key_buffer	= get_xor_key(filename)
+	decompressor	= zlib.decompressobj()
+	phase		= 0
+	length		= 0
+	while True:
+		data = fd.read(chunk_size)
+		if not data:
+			break
+
+		# Decrypt the chunk, continuing the key from the end of the last chunk
+		data = xor_data(data, key_buffer, phase)
+		phase += len(data)
+		if debug_fd:
+			debug_fd.write(data)
+
+		# Uncompress the chunk, limiting each output block to chunk_size
+		while data:
+			out = decompressor.decompress(data, chunk_size)
+			length += len(out)
+			yield out
+			data = decompressor.unconsumed_tail
+
+	out = decompressor.flush()
+	length += len(out)
+	yield out
+
+	if (length != header.length):
+		print("Warning: uncompressed length %d does not match header length %d" % (length, header.length))
+	if global_vars.verbose >= global_vars.trace_level:
+		print("Uncompressed Length: %d 0x%X" % (length, length))
+
 
 #
 # Observations:
@@ -1267,6 +2587,9 @@ class	PSB_NodeTree:
 
 		self.starting_nodes	= []
 
+		# For each node, a dict of char -> child (index into the self.nodes list)
+		children		= [{}]
+
 		# For each string in our list...
 		#for name_idx, name_str in enumerate(sorted(names, key=len)):
 		for name_idx in range(len(names)):
@@ -1278,11 +2601,10 @@ class	PSB_NodeTree:
 			# For each char in our string
 			for c in name_str.encode('latin-1') + b'\x00':
 				# Check if we match any of our children
-				for child in self.nodes[node_idx].cn:
-					if self.nodes[child].c == c:
-						# Found match, use it
-						node_idx = child
-						break
+				child = children[node_idx].get(c)
+				if child is not None:
+					# Found match, use it
+					node_idx = child
 				else:
 					# Allocate a new node
 					self.nodes.append(PSB_Node())
@@ -1294,6 +2616,8 @@ class	PSB_NodeTree:
 
 					# Add the new node to our list of children
 					self.nodes[node_idx].cn.append(next_idx)
+					children[node_idx][c] = next_idx
+					children.append({})
 
 					# Set the new node to the new char
 					self.nodes[next_idx].c = c
@@ -1311,6 +2635,7 @@ class	PSB_NameTable:
 		self.offsets	= []
 		self.starts	= []
 		self.debug_tree	= None
+		self.next_free	= []	# Index of unused jump entries, see find_free_jump
 
 	def	build_debug_tree(self, prefix):
 		self.debug_tree	= [None] * len(self.jumps)
@@ -1394,6 +2719,66 @@ class	PSB_NameTable:
 
 		return accum
 
+	#
+	# Decode every name at once.
+	#
+	# Each jump entry is the last character of a prefix which is shared by every name passing through it,
+	# so we save the prefix ending at each entry and only walk up the table from the entries we have not seen.
+	# This gives the same names as get_name for each index.
+	#
+	def	decode_all(self):
+		NEW		= 0
+		WALKING		= 1	# On the current walk
+		DECODED		= 2	# prefixes[] is filled in
+
+		state		= bytearray(len(self.jumps))
+		prefixes	= [None] * len(self.jumps)
+		names		= []
+		for a in self.starts:
+			# Walk up towards the root, until we reach an entry we have already decoded
+			path = []
+			b = a
+			while b != 0 and state[b] != DECODED:
+				if state[b] == WALKING:
+					break
+				state[b] = WALKING
+				path.append(b)
+				b = self.jumps[b]
+
+			if b != 0 and state[b] == WALKING:
+				# Loop detected, return what we have decoded (like get_name)
+				c = b
+				b = path[-1]
+				print("Loop detected in jump table:")
+				print("b: %d " % b, end="")
+				print("c: %d " % c, end="")
+				print("d: %d " % self.offsets[c], end="")
+				print("e: %d " % (b - self.offsets[c]), end="")
+				print("")
+				names.append(''.join(chr(b - self.offsets[self.jumps[b]]) for b in reversed(path[ : -1])))
+				for b in path:
+					state[b] = NEW
+				continue
+
+			# Walk back down, saving the prefix at each entry
+			if b == 0:
+				prefix = ""
+			else:
+				prefix = prefixes[b]
+			for b in reversed(path):
+				e = b - self.offsets[self.jumps[b]]
+				if e < 0:
+					print("b: %d " % b, end="")
+					print("c: %d " % self.jumps[b], end="")
+					print("d: %d " % self.offsets[self.jumps[b]], end="")
+					print("e: %d " % e, end="")
+					print("")
+				prefix += chr(e)
+				prefixes[b] = prefix
+				state[b] = DECODED
+			names.append(prefix)
+		return names
+
 	def	build_tables(self, names):
 		self.jumps	= []
 		self.offsets	= []
@@ -1403,12 +2788,37 @@ class	PSB_NameTable:
 		node_tree.add_strings(names)
 
 		self.build_jumps(node_tree)
-		#self.build_jumps2(node_tree)
 		self.build_offsets(node_tree)
 		self.build_starts(node_tree)
 
 
+	# Extend the jumps table (and our index of unused entries) to length entries
+	def	extend_jumps(self, length):
+		if len(self.jumps) < length:
+			self.next_free.extend(range(len(self.jumps), length))
+			self.jumps.extend([None] * (length - len(self.jumps)))
+
+	# Set a jump entry, and remove it from our index of unused entries
+	def	set_jump(self, ji, pji):
+		self.jumps[ji]		= pji
+		self.next_free[ji]	= ji + 1
+
+	# Find the first unused jump entry at or after ji (or the end of the table).
+	# next_free[ji] is ji for an unused entry, otherwise it points at a later entry to try.
+	# Entries are never freed, so we can point every entry we pass straight at the result.
+	def	find_free_jump(self, ji):
+		free_ji = ji
+		while free_ji < len(self.jumps) and self.next_free[free_ji] != free_ji:
+			free_ji = self.next_free[free_ji]
+		while ji < free_ji:
+			next_ji = self.next_free[ji]
+			self.next_free[ji] = free_ji
+			ji = next_ji
+		return free_ji
+
 	def	build_jumps(self, node_tree):
+		self.jumps	= []
+		self.next_free	= []
 		for ni in range(len(node_tree.nodes)):
 			# Skip the root node
 			if ni:
@@ -1419,26 +2829,20 @@ class	PSB_NameTable:
 					min_ji = node_tree.nodes[ni].c + 1
 
 					# Extend the table if needed
-					if len(self.jumps) <= min_ji:
-						self.jumps.extend([None] * (min_ji - len(self.jumps) +1))
+					self.extend_jumps(min_ji + 1)
 
 					# Find the first unused jump entry
-					for ji in range(min_ji, len(self.jumps)):
-						if self.jumps[ji] is None:
-							break
-					else:
-						# We didn't find one, extend the table
-						# Set our jump index to the next unused entry
-						ji = len(self.jumps)
-						# Extend the table by 1
-						self.jumps.extend([None] * 1)
+					ji = self.find_free_jump(min_ji)
+
+					# If we didn't find one, extend the table by 1
+					self.extend_jumps(ji + 1)
 
 					# Save our node's jump index
 					node_tree.nodes[ni].ji = ji
 					# Set our jump value to our parent's jump index
 					p = node_tree.nodes[ni].p
 					pji = node_tree.nodes[p].ji
-					self.jumps[ji] = pji
+					self.set_jump(ji, pji)
 
 			# If we have >1 children, add space for the range of chars
 			# We could search for a gap, but it would be very unlikely.
@@ -1459,7 +2863,7 @@ class	PSB_NameTable:
 				ji_last = ji_first - c_min + c_max
 
 				# Extend the jump table
-				self.jumps.extend([None] * (ji_last - len(self.jumps) +1))
+				self.extend_jumps(ji_last + 1)
 
 				# For each child...
 				for ci in node_tree.nodes[ni].cn:
@@ -1467,7 +2871,7 @@ class	PSB_NameTable:
 					ji_child = ji_first - c_min + node_tree.nodes[ci].c
 					node_tree.nodes[ci].ji = ji_child
 					# Set our child's jump target to ourselves
-					self.jumps[ji_child] = node_tree.nodes[ni].ji
+					self.set_jump(ji_child, node_tree.nodes[ni].ji)
 
 		# Fix any remaining None entries
 		fixed=0
@@ -1475,87 +2879,8 @@ class	PSB_NameTable:
 			if self.jumps[ji] is None:
 				self.jumps[ji] = 0
 				fixed += 1
-		print("Fixed %d gaps" % fixed)
-
-	# Brute-force search for gaps
-	# This works ok-ish, but leaves more gaps than build_jumps1!
-	def	build_jumps2(self, node_tree):
-		self.jumps = [None] * len(node_tree.nodes)
-		for ni in range(len(node_tree.nodes)):
-			if node_tree.nodes[ni].ji == 0:
-				# Find a space for ourselves
-				for offset in range(1, len(self.jumps)):
-					o = offset + node_tree.nodes[ni].c
-					# Make sure the table is long enough
-					if len(self.jumps) <= o:
-						self.jumps.extend([None] * (o - len(self.jumps) +1))
-						print("Extending jumps table to %d entries" % len(self.jumps))
-					# If this entry is empty, we can use it.
-					if self.jumps[o] is None:
-						node_tree.nodes[ni].ji = o
-						pi = node_tree.nodes[ni].p
-						self.jumps[o] = node_tree.nodes[pi].ji
-						# Quit the offset search loop
-						break
-				else:
-					# We got to the end of the jumps table without finding a free slot - extend the table
-					offset = len(self.jumps)
-					o = offset + node_tree.nodes[ni].c
-					# Make sure the table is long enough
-					if len(self.jumps) <= o:
-						self.jumps.extend([None] * (o - len(self.jumps) +1))
-						print("Extending jumps table to %d entries" % len(self.jumps))
-					# Use the new empty entry
-					node_tree.nodes[ni].ji = o
-					pi = node_tree.nodes[ni].p
-					self.jumps[o] = node_tree.nodes[pi].ji
-			# Find a space for our children
-			for offset in range(1, len(self.jumps)):
-				# For each child we have...
-				for ci in node_tree.nodes[ni].cn:
-					o = offset + node_tree.nodes[ci].c
-					# Make sure the table is long enough
-					if len(self.jumps) <= o:
-						self.jumps.extend([None] * (o - len(self.jumps) +1))
-						print("Extending jumps table to %d entries" % len(self.jumps))
-					# If this entry is used, quit the child loop and try the next offset
-					#print(ni, offset, o, len(self.jumps))
-					if self.jumps[o] is not None:
-						break
-				else:
-					# We have found a set of unused slots!
-					# For each child...
-					for ci in node_tree.nodes[ni].cn:
-						o = offset + node_tree.nodes[ci].c
-						# Make sure the table is long enough
-						assert(len(self.jumps) > o)
-						# Set our child node's jump index
-						node_tree.nodes[ci].ji = o
-						# Set our child's jump target to our jump index
-						self.jumps[o] = node_tree.nodes[ni].ji
-					# Quit the offset search loop
-					break
-			else:
-				# We got to the end of the jumps table without finding a free slot - extend the table
-				offset = len(self.jumps)
-				# For each child...
-				for ci in node_tree.nodes[ni].cn:
-					o = offset + node_tree.nodes[ci].c
-					# Make sure the table is long enough
-					if len(self.jumps) <= o:
-						self.jumps.extend([None] * (o - len(self.jumps) +1))
-						print("Extending jumps table to %d entries" % len(self.jumps))
-					# Set our child node's jump index
-					node_tree.nodes[ci].ji = o
-					# Set our child's jump target to our jump index
-					self.jumps[o] = node_tree.nodes[ni].ji
-		# Fix any remaining None entries
-		fixed = 0
-		for ji in range(len(self.jumps)):
-			if self.jumps[ji] is None:
-				self.jumps[ji] = 0
-				fixed += 1
-		print("Fixed %d gaps" % fixed)
+		if global_vars.verbose >= global_vars.debug_level:
+			print("Fixed %d gaps" % fixed)
 
 	# Fill in the offsets table
 	def	build_offsets(self, node_tree):
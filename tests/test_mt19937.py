@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+#
+# Check MT19937 against the reference output of mt19937ar.c,
+# as printed by mt19937.main() (init_by_array([0x123, 0x234, 0x345, 0x456])).
+#
+
+import	array
+import	unittest
+
+import	inject_gba.mt19937	as mt19937
+
+REFERENCE_KEY = [0x123, 0x234, 0x345, 0x456]
+
+# The first and last 10 of the 1000 reference outputs of genrand_int32()
+REFERENCE_HEAD = [
+	1067595299,  955945823,  477289528, 4107218783, 4228976476,
+	3344332714, 3355579695,  227628506,  810200273, 2591290167,
+]
+REFERENCE_TAIL = [
+	 988064871, 3515461600, 4089077232, 2225147448, 1249609188,
+	2643151863, 3896204135, 2416995901, 1397735321, 3460025646,
+]
+
+def	make_mt():
+	mt = mt19937.MT19937()
+	mt.init_by_array(REFERENCE_KEY)
+	return mt
+
+class	TestMT19937(unittest.TestCase):
+
+	def	test_genrand_int32(self):
+		mt = make_mt()
+		words = [mt.genrand_int32() for _ in range(1000)]
+		self.assertEqual(words[ : 10], REFERENCE_HEAD)
+		self.assertEqual(words[-10 : ], REFERENCE_TAIL)
+
+	def	test_genrand_block(self):
+		words = make_mt().genrand_block(1000)
+		self.assertIsInstance(words, array.array)
+		self.assertEqual(list(words[ : 10]), REFERENCE_HEAD)
+		self.assertEqual(list(words[-10 : ]), REFERENCE_TAIL)
+
+	def	test_genrand_block_bytes(self):
+		data = make_mt().genrand_block(1000, as_bytes = True)
+		self.assertEqual(len(data), 4000)
+		self.assertEqual(data[ : 4], REFERENCE_HEAD[0].to_bytes(4, 'little'))
+		self.assertEqual(data[-4 : ], REFERENCE_TAIL[-1].to_bytes(4, 'little'))
+
+	# Blocks which start and end either side of the 624 word twist
+	def	test_genrand_block_twist_boundary(self):
+		reference = make_mt()
+		expected = [reference.genrand_int32() for _ in range(3 * mt19937.N)]
+
+		for sizes in [[1, 623, 1], [623, 2, 624], [624, 624], [625, 624], [100, 1200, 3], [3 * mt19937.N]]:
+			mt = make_mt()
+			words = []
+			for n in sizes:
+				words += mt.genrand_block(n)
+			self.assertEqual(words, expected[ : len(words)], sizes)
+
+	# Mixing genrand_int32 and genrand_block continues the same sequence
+	def	test_genrand_mixed(self):
+		reference = make_mt()
+		expected = [reference.genrand_int32() for _ in range(1300)]
+
+		mt = make_mt()
+		words = [mt.genrand_int32() for _ in range(620)]
+		words += mt.genrand_block(10)
+		words += [mt.genrand_int32() for _ in range(10)]
+		words += mt.genrand_block(660)
+		self.assertEqual(words, expected)
+
+	def	test_instances_do_not_share_state(self):
+		a = make_mt()
+		b = make_mt()
+		a.genrand_block(700)
+		self.assertEqual(b.genrand_int32(), REFERENCE_HEAD[0])
+
+		# Nor with the module-level generator
+		mt19937.init_by_array(REFERENCE_KEY)
+		c = mt19937.MT19937(5489)
+		c.genrand_block(1000)
+		self.assertEqual(mt19937.genrand_int32(), REFERENCE_HEAD[0])
+		self.assertEqual(a.genrand_int32(), make_mt().genrand_block(701)[-1])
+
+	# The default seed is used if the generator is not seeded
+	def	test_default_seed(self):
+		self.assertEqual(mt19937.MT19937().genrand_int32(), 3499211612)
+		self.assertEqual(mt19937.MT19937(5489).genrand_int32(), 3499211612)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+#
+# Check PSB.pack_object (measure the tree, then write each object once)
+# against the original encoder, which packed every child into a temporary buffer.
+#
+
+import	random
+import	struct
+import	sys
+import	unittest
+
+import	inject_gba.psb		as psb
+
+NAMES = ['file_info', 'id', 'image', 'pos', 'rom', 'size', 'sub/file_info', 'system/roms/rom.bin', 'x', 'y']
+FILE_INFO_NI = NAMES.index('file_info')
+
+#
+# The original recursive encoder, packing each child on its own to get the offsets.
+# If fileinfo is given, obj is the root of the entries tree and its file_info list is re-populated from fileinfo.
+#
+def	reference_pack(obj, fileinfo = None, name = ''):
+	t = obj.t
+	if (t >= 1 and t <= 3) or t == 29:
+		return bytes([t])
+	elif t >= 4 and t <= 12:
+		if obj.v == 0:
+			return bytes([4])
+		s = psb.getIntSize(obj.v)
+		return bytes([4 + s]) + obj.v.to_bytes(s, 'little')
+	elif t == 100:
+		if obj.v == 0:
+			return bytes([4])
+		s = psb.getUnsignedIntSize(obj.v)
+		return bytes([4 + s]) + obj.v.to_bytes(s, 'little')
+	elif t >= 13 and t <= 20:
+		count = len(obj.v)
+		s = psb.getIntSize(count)
+		data = bytes([12 + s]) + count.to_bytes(s, 'little')
+		s = psb.getIntSize(max(obj.v) if count else 0)
+		data += bytes([12 + s])
+		for v in obj.v:
+			data += v.to_bytes(s, 'little')
+		return data
+	elif t >= 21 and t <= 24:
+		s = psb.getIntSize(obj.v)
+		return bytes([20 + s]) + obj.v.to_bytes(s, 'little')
+	elif t >= 25 and t <= 28:
+		s = psb.getIntSize(obj.v)
+		return bytes([24 + s]) + obj.v.to_bytes(s, 'little')
+	elif t == 30:
+		return bytes([t]) + struct.pack('<f', obj.v)
+	elif t == 31:
+		return bytes([t]) + struct.pack('<d', obj.v)
+	elif t == 32:
+		children = [reference_pack(o, fileinfo) for o in obj.v]
+		return bytes([t]) + reference_pack(psb.TypeValue(13, offsets_of(children)), fileinfo) + b''.join(children)
+	elif t == 33:
+		items = [(no.ni, no.o) for no in obj.v]
+		if name == '|file_info' and fileinfo is not None:
+			items = [(fi.ni, psb.TypeValue(32, [psb.TypeValue(100, fi.o), psb.TypeValue(100, fi.l)])) for fi in fileinfo]
+		children = [reference_pack(o, fileinfo, name + '|' + NAMES[ni]) for ni, o in items]
+		return bytes([t]) + reference_pack(psb.TypeValue(13, [ni for ni, o in items]), fileinfo) + reference_pack(psb.TypeValue(13, offsets_of(children)), fileinfo) + b''.join(children)
+	raise ValueError("Unknown type %d" % t)
+
+def	offsets_of(children):
+	offsets = []
+	offset = 0
+	for data in children:
+		offsets.append(offset)
+		offset += len(data)
+	return offsets
+
+# One value of each non-container type tag, with values of each size its tag allows
+def	make_values():
+	values = [psb.TypeValue(t, None) for t in (1, 2, 3, 29)]
+	for v in [0, 1, 0x7F, 0xFF, 0x100, 0xFFFF, 0x10000, 0x7FFFFFFF, 0xFFFFFFFF, 1 << 40, (1 << 56) - 1]:
+		values.append(psb.TypeValue(4 + (psb.getIntSize(v) if v else 0), v))
+		if v < (1 << 55):
+			values.append(psb.TypeValue(100, v))
+	for v in [[], [0], [1, 2, 3], [0xFF, 0x100], [0x12345678, 0], list(range(300)), [1 << 40]]:
+		values.append(psb.TypeValue(13, v))
+	for v in [0, 0xFF, 0x100, 0xFFFF, 0x10000]:
+		values.append(psb.String(20 + psb.getIntSize(v), v))
+		values.append(psb.TypeValue(24 + psb.getIntSize(v), v))
+	values.append(psb.TypeValue(30, 1.5))
+	values.append(psb.TypeValue(31, -2.25e100))
+	return values
+
+# A random tree of type 32/33 containers, with every kind of value in the leaves
+def	make_tree(rng, values, depth = 0):
+	t = rng.choice([32, 33])
+	children = []
+	for _ in range(rng.randint(0, 6)):
+		if depth < 5 and rng.random() < 0.4:
+			child = make_tree(rng, values, depth + 1)
+		else:
+			child = rng.choice(values)
+		children.append(child)
+	if t == 32:
+		return psb.TypeValue(32, children)
+	return psb.TypeValue(33, [psb.NameObject(rng.randrange(len(NAMES)), child) for child in children])
+
+def	make_psb():
+	mypsb = psb.PSB()
+	mypsb.names = NAMES
+	mypsb.file_info_ni = FILE_INFO_NI
+	# Enough strings and chunks for the indexes in make_values, for unpacking
+	mypsb.strings = [''] * 0x10001
+	mypsb.chunkdata = [b''] * 0x10001
+	return mypsb
+
+def	pack(mypsb, obj, flags = 0):
+	packer = psb.buffer_packer()
+	mypsb.pack_object(packer, '', obj, flags = flags)
+	return packer.getvalue()
+
+class	TestPackObject(unittest.TestCase):
+
+	def	test_values(self):
+		mypsb = make_psb()
+		for obj in make_values():
+			self.assertEqual(pack(mypsb, obj), reference_pack(obj), obj)
+
+	def	test_containers(self):
+		mypsb = make_psb()
+		values = make_values()
+		containers = [
+			psb.TypeValue(32, []),
+			psb.TypeValue(33, []),
+			psb.TypeValue(32, values),
+			psb.TypeValue(33, [psb.NameObject(i % len(NAMES), v) for i, v in enumerate(values)]),
+			psb.TypeValue(32, [psb.TypeValue(32, [psb.TypeValue(32, [psb.TypeValue(4, 0)])])]),
+		]
+		for obj in containers:
+			self.assertEqual(pack(mypsb, obj), reference_pack(obj))
+
+	def	test_random_trees(self):
+		rng = random.Random(8)
+		mypsb = make_psb()
+		values = make_values()
+		for _ in range(300):
+			tree = make_tree(rng, values)
+			self.assertEqual(pack(mypsb, tree), reference_pack(tree))
+
+	# The root's file_info list is re-populated from our FileInfo, a nested file_info is packed as-is
+	def	test_file_info(self):
+		mypsb = make_psb()
+		mypsb.subfile_data = [bytes(0x900), bytes(0x10), bytes(0x800)]
+		mypsb.fileinfo = [psb.FileInfo(NAMES.index('system/roms/rom.bin'), 0x900, 0), psb.FileInfo(NAMES.index('image'), 0x10, 0x1000), psb.FileInfo(NAMES.index('x'), 0x800, 0x1800)]
+
+		stale = psb.TypeValue(33, [psb.NameObject(NAMES.index('y'), psb.TypeValue(32, [psb.TypeValue(4, 0), psb.TypeValue(4, 0)]))])
+		nested = psb.TypeValue(33, [psb.NameObject(FILE_INFO_NI, psb.TypeValue(33, [psb.NameObject(NAMES.index('x'), psb.TypeValue(5, 1))]))])
+		root = psb.TypeValue(33, [
+			psb.NameObject(NAMES.index('id'),	psb.String(21, 3)),
+			psb.NameObject(FILE_INFO_NI,		stale),
+			psb.NameObject(NAMES.index('image'),	nested),
+			psb.NameObject(NAMES.index('pos'),	psb.TypeValue(30, 0.5)),
+		])
+
+		data = pack(mypsb, root, flags = psb.ENTRY_ROOT)
+		self.assertEqual(data, reference_pack(root, mypsb.fileinfo))
+
+		# Without ENTRY_ROOT the tree is packed as it is
+		plain = psb.TypeValue(33, [psb.NameObject(FILE_INFO_NI, psb.TypeValue(33, []))])
+		self.assertEqual(pack(mypsb, plain), reference_pack(plain))
+
+		# And decodes to the same FileInfo
+		unpacked = make_psb()
+		unpacked.unpack_object(psb.buffer_unpacker(data), '', psb.ENTRY_ROOT)
+		self.assertEqual([(fi.ni, fi.l, fi.o) for fi in unpacked.fileinfo], [(fi.ni, fi.l, fi.o) for fi in mypsb.fileinfo])
+
+	# Packing what we unpacked gives the same bytes
+	# (type 100 is internal, it is unpacked as a type 4-12 int)
+	def	test_roundtrip(self):
+		rng = random.Random(14)
+		mypsb = make_psb()
+		values = [v for v in make_values() if v.t != 100]
+		for _ in range(100):
+			data = pack(mypsb, make_tree(rng, values))
+			obj = mypsb.unpack_object(psb.buffer_unpacker(data))
+			self.assertEqual(pack(mypsb, obj), data)
+
+	# Trees nested deeper than the recursion limit can be unpacked, decoded and packed again
+	def	test_deep_nesting(self):
+		depth = 3000
+		obj = psb.TypeValue(4, 0)
+		for i in range(depth):
+			if i % 2:
+				obj = psb.TypeValue(32, [obj])
+			else:
+				obj = psb.TypeValue(33, [psb.NameObject(NAMES.index('x'), obj)])
+
+		self.assertGreater(depth, sys.getrecursionlimit())
+		data = pack(make_psb(), obj)
+
+		for lazy in (False, True):
+			unpacked = make_psb()
+			unpacked.psb_data = data
+			unpacked.lazy = lazy
+			tree = unpacked.unpack_object(psb.buffer_unpacker(data))
+			decoded = unpacked.decode_object(tree)
+			self.assertEqual(psb.get_tree_depth(decoded), depth)
+			self.assertEqual(pack(unpacked, decoded), data)
+			self.assertEqual(pack(unpacked, tree), data)
+
+	# A container whose offsets are not in order is unpacked to its real end,
+	# and is decoded (not copied) when packing a lazily unpacked tree
+	def	test_unordered_offsets(self):
+		mypsb = make_psb()
+		first	= psb.TypeValue(32, [psb.TypeValue(5, 1), psb.TypeValue(5, 2)])
+		second	= psb.TypeValue(5, 3)
+		first_data	= pack(mypsb, first)
+		second_data	= pack(mypsb, second)
+		# The second child's bytes come first
+		unordered = bytes([32]) + pack(mypsb, psb.TypeValue(13, [len(second_data), 0])) + second_data + first_data
+		outer = bytes([32]) + pack(mypsb, psb.TypeValue(13, [0, len(unordered)])) + unordered + pack(mypsb, psb.TypeValue(5, 4))
+
+		expected = pack(mypsb, psb.TypeValue(32, [psb.TypeValue(32, [first, second]), psb.TypeValue(5, 4)]))
+		for lazy in (False, True):
+			unpacked = make_psb()
+			unpacked.psb_data = outer
+			unpacked.lazy = lazy
+			unpacker = psb.buffer_unpacker(outer)
+			tree = unpacked.unpack_object(unpacker)
+			self.assertEqual(unpacker.tell(), len(outer))
+			self.assertEqual(pack(unpacked, tree), expected)
+
+if __name__ == "__main__":
+	unittest.main()
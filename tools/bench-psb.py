@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+#
+# Benchmarks for the psb module hot paths.
+#
+# Usage:
+#	bench-psb.py [--no-numpy] [benchmark ...]
+#
+
+import	argparse
+import	os
+import	struct
+import	sys
+import	tempfile
+import	time
+import	tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import	inject_gba.psb		as psb
+
+MiB = 1024 * 1024
+
+# Run func once, return the elapsed time in seconds
+def	timeit(func, *args):
+	start = time.perf_counter()
+	func(*args)
+	return time.perf_counter() - start
+
+##################################################
+#
+#	xor
+#
+#	Compare the per-byte XOR loop with psb.xor_data
+#
+
+def	xor_loop(data, key_buffer):
+	data = bytearray(data)
+	key_len = len(key_buffer)
+	for i in range(len(data)):
+		data[i] ^= key_buffer[i % key_len]
+	return data
+
+def	bench_xor(args):
+	key_buffer = psb.get_xor_key('alldata.psb.m')
+	for size in [4 * MiB, 16 * MiB, 32 * MiB]:
+		data = os.urandom(size)
+		t_new = timeit(psb.xor_data, data, key_buffer)
+		if args.quick:
+			print("xor %3d MiB: xor_data %.3fs" % (size // MiB, t_new))
+			continue
+		t_old = timeit(xor_loop, data, key_buffer)
+		assert(xor_loop(data[:0x1000], key_buffer) == psb.xor_data(data[:0x1000], key_buffer))
+		print("xor %3d MiB: loop %.3fs xor_data %.3fs speedup %.0fx" % (size // MiB, t_old, t_new, t_old / t_new))
+
+##################################################
+#
+#	make_psb
+#
+#	Build a synthetic PSB with count subfiles, and return it unpacked
+#	from its packed form (as if read from disk).
+#
+
+def	make_psb(count):
+	mypsb = psb.PSB()
+	files = ['system/roms/rom.bin'] + ['image/%03d/pic%05d.jpg.m' % (i % 97, i) for i in range(count - 1)]
+	mypsb.names = sorted(set(['file_info', 'id', 'version'] + files))
+	ni = {n: i for i, n in enumerate(mypsb.names)}
+	mypsb.strings = ['archive']
+
+	mypsb.subfile_data = []
+	for f in files:
+		mypsb.fileinfo.append(psb.FileInfo(ni[f], 0, 0))
+		mypsb.subfile_data.append(bytearray(64 + len(f)))
+	mypsb.entries = psb.TypeValue(33, [
+		psb.NameObject(ni['file_info'],	psb.TypeValue(33, [])),
+		psb.NameObject(ni['id'],	psb.String(21, 0)),
+		psb.NameObject(ni['version'],	psb.TypeValue(5, 1)),
+	])
+
+	subfile_data = mypsb.subfile_data
+	mypsb = unpack_psb(mypsb.pack())
+	mypsb.subfile_data = subfile_data
+	return mypsb
+
+def	unpack_psb(psb_data):
+	mypsb = psb.PSB()
+	mypsb.unpack(psb_data)
+	return mypsb
+
+##################################################
+#
+#	pack
+#
+#	Time PSB.pack() re-encoding the entries, with the original list-based packer and the current packer
+#
+
+class	list_packer():
+	def __init__(self):
+		self._buffer = []
+		self._offset = 0
+
+	def __call__(self, fmt, data):
+		packed_data = struct.pack(fmt, data)
+		packed_length = len(packed_data)
+		self.setlength(self._offset + packed_length)
+		self._buffer[self._offset : self._offset + packed_length] = packed_data
+		self._offset += packed_length
+
+	# The typed writers used by the psb module, built on __call__ as the original packer did
+	def	write_bytes(self, packed_data):
+		self('%ds' % len(packed_data), bytes(packed_data))
+
+	def	write_u8(self, v):
+		self('<B', v)
+
+	def	write_u32(self, v):
+		self('<I', v)
+
+	def	write_uint(self, v, size):
+		self.write_bytes(v.to_bytes(size, 'little'))
+
+	def	write_f32(self, v):
+		self('<f', v)
+
+	def	write_f64(self, v):
+		self('<d', v)
+
+	def	length(self):
+		return len(self._buffer)
+
+	def	seek(self, offset):
+		self.setlength(offset)
+		self._offset = offset
+
+	def	setlength(self, length):
+		if len(self._buffer) < length:
+			self._buffer = self._buffer + [0] * (length - len(self._buffer))
+
+	def	tell(self):
+		return self._offset
+
+	def	getbuffer(self):
+		return bytes(self._buffer)
+
+	def	getvalue(self):
+		return bytes(self._buffer)
+
+def	bench_pack(args):
+	for count in [500, 1000, 2000, 4000]:
+		mypsb = make_psb(count)
+
+		def	repack():
+			mypsb.raw_entries = None
+			return mypsb.pack()
+
+		t_new = timeit(repack)
+		if args.quick:
+			print("pack %5d entries: %.3fs" % (count, t_new))
+			continue
+
+		current_packer = psb.buffer_packer
+		psb.buffer_packer = list_packer
+		try:
+			t_old = timeit(repack)
+			old_data = repack()
+		finally:
+			psb.buffer_packer = current_packer
+		assert(old_data == repack())
+		print("pack %5d entries: list %.3fs bytearray %.3fs speedup %.1fx" % (count, t_old, t_new, t_old / t_new))
+
+##################################################
+#
+#	nodes
+#
+#	Measure the memory used per decoded node, with the original dict-based classes and the slotted classes
+#
+
+class	dict_TypeValue():
+	def	__init__(self, t, v):
+		self.t = t
+		self.v = v
+
+class	dict_NameObject():
+	def	__init__(self, ni, o, ns=None):
+		self.ni = ni
+		self.o  = o
+		self.ns = ns
+
+class	dict_String():
+	def	__init__(self, t, v, s=None):
+		self.t = t
+		self.v = v
+		self.s = s
+
+def	count_nodes(obj):
+	if obj.t == 32:
+		return 1 + sum(count_nodes(o) for o in obj.v)
+	if obj.t == 33:
+		return 1 + sum(1 + count_nodes(no.o) for no in obj.v)
+	return 1
+
+# Get the memory used by the decoded entries tree, and the number of nodes in it
+def	measure_nodes(psb_data):
+	tracemalloc.start()
+	mypsb = unpack_psb(psb_data)
+	nodes = count_nodes(mypsb.entries)
+	with_entries = tracemalloc.get_traced_memory()[0]
+	mypsb.entries = None
+	without_entries = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return with_entries - without_entries, nodes
+
+def	bench_nodes(args):
+	for count in [1000, 4000]:
+		psb_data = make_psb(count).pack()
+
+		size, nodes = measure_nodes(psb_data)
+
+		classes = (psb.TypeValue, psb.NameObject, psb.String)
+		psb.TypeValue, psb.NameObject, psb.String = dict_TypeValue, dict_NameObject, dict_String
+		try:
+			old_size, old_nodes = measure_nodes(psb_data)
+		finally:
+			psb.TypeValue, psb.NameObject, psb.String = classes
+		print("nodes %5d entries (%d nodes): dict %.0f bytes/node slots %.0f bytes/node" % (count, nodes, old_size / old_nodes, size / nodes))
+
+##################################################
+#
+#	names
+#
+#	Time building a names table with PSB_NameTable.build_tables,
+#	and compare decoding it with PSB_NameTable.get_name per name and PSB_NameTable.decode_all
+#
+
+# Synthetic file paths, sharing directory prefixes
+def	make_paths(count):
+	return ['image/%03d/%02d/pic%06d.jpg.m' % (i % 97, i % 13, i) for i in range(count)]
+
+def	bench_names(args):
+	for count in [5000, 50000]:
+		names = make_paths(count)
+		nt = psb.PSB_NameTable()
+		t_build = timeit(nt.build_tables, names)
+		print("names %5d paths (%d jumps): build_tables %.3fs" % (count, len(nt.jumps), t_build))
+
+		t_new = timeit(nt.decode_all)
+		assert([s.rstrip('\0') for s in nt.decode_all()] == names)
+		if args.quick:
+			print("names %5d paths (%d jumps): decode_all %.3fs" % (count, len(nt.jumps), t_new))
+			continue
+
+		# get_name is O(table size) per name, so only time a sample of the names
+		sample = min(count, 2000)
+		t_old = timeit(lambda: [nt.get_name(i) for i in range(sample)]) * count / sample
+		assert([nt.get_name(i) for i in range(sample)] == nt.decode_all()[ : sample])
+		print("names %5d paths (%d jumps): get_name %.3fs%s decode_all %.3fs speedup %.0fx" % (count, len(nt.jumps), t_old, ' (est.)' if sample < count else '', t_new, t_old / t_new))
+
+##################################################
+#
+#	bin
+#
+#	Compare writing an unmodified alldata.bin from the mapped input file,
+#	with buffered writes of the mapped subfiles and with PSB.write_subfiles (copy_file_data)
+#
+
+def	bench_bin(args):
+	size = 64 * MiB if args.quick else 512 * MiB
+	count = 64
+
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		in_filename	= os.path.join(tmp_dir, 'in.bin')
+		out_filename	= os.path.join(tmp_dir, 'out.bin')
+
+		# Write a synthetic alldata.bin, with subfiles which need padding
+		mypsb = make_psb(count)
+		chunk = os.urandom(size // count - 0x123)
+		mypsb.subfile_data = [chunk] * count
+		with open(in_filename, 'wb') as f:
+			mypsb.write_subfiles(f)
+		mypsb.subfile_data = None
+		bin_size = os.path.getsize(in_filename)
+
+		mypsb.map_subfiles(in_filename)
+
+		def	write_buffered():
+			with open(out_filename, 'wb') as f:
+				f.writelines(mypsb.iter_bin_blocks())
+
+		def	write_copy():
+			with open(out_filename, 'wb') as f:
+				mypsb.write_subfiles(f)
+
+		# Best of 3, so neither gets the cold page cache.
+		# Remove the previous output first, truncating it would be timed too.
+		def	best_of_3(func):
+			times = []
+			for _ in range(3):
+				if os.path.exists(out_filename):
+					os.remove(out_filename)
+				times.append(timeit(func))
+			return min(times)
+
+		t_old = best_of_3(write_buffered)
+		t_new = best_of_3(write_copy)
+		assert(open(in_filename, 'rb').read() == open(out_filename, 'rb').read())
+		mypsb.unmap_subfiles()
+
+		print("bin %4d MiB: buffered %.3fs (%.0f MiB/s) copy_file_data %.3fs (%.0f MiB/s)" % (bin_size // MiB, t_old, bin_size / MiB / t_old, t_new, bin_size / MiB / t_new))
+
+benchmarks = {
+	'bin':		bench_bin,
+	'names':	bench_names,
+	'nodes':	bench_nodes,
+	'pack':		bench_pack,
+	'xor':		bench_xor,
+}
+
+def	main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument(		'--no-numpy',	dest='no_numpy',	help='Benchmark without numpy',			action='store_true',	default=False)
+	parser.add_argument(		'--quick',	dest='quick',		help='Skip the slow reference implementations',	action='store_true',	default=False)
+	parser.add_argument(		'names',	metavar='BENCHMARK', nargs='*', help='Run BENCHMARK (default all): %s' % ', '.join(sorted(benchmarks)))
+	args = parser.parse_args()
+
+	if args.no_numpy:
+		psb.numpy = None
+
+	for name in args.names or sorted(benchmarks):
+		benchmarks[name](args)
+
+if __name__ == "__main__":
+	main()
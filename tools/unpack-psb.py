@@ -179,9 +179,7 @@ def	write_chunks(mypsb):
 # Write out the ADB
 def	write_bin(mypsb):
 
-	# Join the subfiles back into a single ADB
-	bin_data = mypsb.join_subfiles()
-	if bin_data is None:
+	if not mypsb.fileinfo:
 		return
 
 	filename = options.basename + '.bin'
@@ -193,7 +191,9 @@ def	write_bin(mypsb):
 	if not options.quiet:
 		print("Writing '%s'" % filename)
 
-	open(filename, 'wb').write(bytes(bin_data))
+	# Write the subfiles straight into the ADB
+	with open(filename, 'wb') as f:
+		mypsb.write_subfiles(f)
 
 
 def	replace_rom_file(mypsb):